@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+## Benchmark of parsing the app's csv backups with parseData(), on large
+## backups from gendata.py.  Pass another copy of the script to compare
+## against it, e.g. one saved with
+##   git show <commit>:processData-20180516.py > /tmp/before.py
+##
+## Usage: python bench/bench_csv.py [--against SCRIPT] [players ...]
+##   players per team per sheet; default 25 100 400.
+
+from __future__ import print_function
+
+import argparse
+import imp
+import logging
+import os.path
+import random
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'processData-20180516.py')
+gendata = imp.load_source('gendata', os.path.join(HERE, 'gendata.py'))
+
+# Return a csv backup with 4 sessions of 10 sheets, without non-ascii
+# comments, so that all of it is parsed.
+def makeBackup(players):
+    opts = gendata.parser().parse_args(['--sessions', '4', '--sheets', '10', '--teams', '4',
+                                        '--players', str(players), '--non-ascii', '0'])
+    fileData = gendata.makeFile(random.Random(1), opts, 0)
+    return gendata.toCsv(fileData).encode('ascii')
+
+def parseTime(module, data):
+    return min(timeit.repeat(lambda: module.parseData('soccer.csv', data), number=1, repeat=5))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--against', metavar='SCRIPT', help='Other copy of the script to time')
+    parser.add_argument('players', nargs='*', type=int, default=[25, 100, 400])
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.CRITICAL)
+
+    modules = [('current', imp.load_source('processData', SCRIPT))]
+    if args.against:
+        modules.append(('against', imp.load_source('against', args.against)))
+
+    print('players,rows,' + ','.join('{} (s)'.format(name) for name, module in modules))
+    for players in args.players:
+        data = makeBackup(players)
+        results = [module.parseData('soccer.csv', data) for name, module in modules]
+        if any(result != results[0] for result in results):
+            print('Results differ for {} players'.format(players), file=sys.stderr)
+        times = [parseTime(module, data) for name, module in modules]
+        print('{},{},'.format(players, data.count(b'\n')) + ','.join('{:.3f}'.format(t) for t in times))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+## Benchmark of the per-player log messages at the default WARNING level:
+## eager "{}".format() messages (as the script used to build them) against
+## lazy %-style arguments with a LogWhere location and level guards.
+##
+## Usage: python bench/bench_logging.py [players]
+
+from __future__ import print_function
+
+import imp
+import logging
+import os.path
+import sys
+import timeit
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processData-20180516.py')
+processData = imp.load_source('processData', SCRIPT)
+
+CATEGORIES = ['A', 'B', 'C', 'D']
+RATINGS = {'A': '3', 'B': '4', 'C': '2', 'D': '5'}
+
+def eager(players):
+    for idNum in range(players):
+        logWhere = "File {}: Session {}: Sheet {}: Player {}{}".format(
+            'soccer.txt', '0522_6-8pm', '6thGirlsNight1Station5Group3', 'Green', idNum)
+        logging.info("{}: Processing...".format(logWhere))
+        logging.debug('{}: Recording team {} in compilation'.format(logWhere, 'Green'))
+        logging.debug('{}: Recording id {} in compilation'.format(logWhere, idNum))
+        logging.info('{}: Adding {} ratings to compilation'.format(logWhere, 'Station5'))
+        for c in CATEGORIES:
+            logging.debug('{}: Adding rating {}={} to compilation'.format(logWhere, c, RATINGS[c]))
+        logging.debug('{}: Adding total {} to compilation'.format(logWhere, 14))
+
+def lazy(players):
+    logInfo = logging.getLogger().isEnabledFor(logging.INFO)
+    logDebug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for idNum in range(players):
+        logWhere = processData.LogWhere('soccer.txt', session='0522_6-8pm',
+                                        sheet='6thGirlsNight1Station5Group3', player=('Green', idNum))
+        if logInfo:
+            logging.info("%s: Processing...", logWhere)
+        logging.debug('%s: Recording team %s in compilation', logWhere, 'Green')
+        logging.debug('%s: Recording id %s in compilation', logWhere, idNum)
+        if logInfo:
+            logging.info('%s: Adding %s ratings to compilation', logWhere, 'Station5')
+        for c in CATEGORIES:
+            if logDebug:
+                logging.debug('%s: Adding rating %s=%s to compilation', logWhere, c, RATINGS[c])
+        if logDebug:
+            logging.debug('%s: Adding total %s to compilation', logWhere, 14)
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    eagerTime = min(timeit.repeat(lambda: eager(players), number=1, repeat=3))
+    lazyTime = min(timeit.repeat(lambda: lazy(players), number=1, repeat=3))
+    print('players,eager (s),lazy (s),speedup')
+    print('{},{:.3f},{:.3f},{:.1f}x'.format(players, eagerTime, lazyTime, eagerTime / lazyTime))
+
+if __name__ == '__main__':
+    main()
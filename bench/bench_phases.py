@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+## Benchmark of the phases of a run on synthetic data from gendata.py,
+## at sizes from one evaluation night to a full season:
+##   ingest   loadFile() of every file
+##   dedup    sheetFingerprint() of every sheet
+##   compile  Compiler.add() of every file (includes dedup)
+##   report   keyReport() of every key, as Compiler.render() does before
+##            it has cached them
+##   export   writeDatabase() (--export-db)
+##   rank     Rankings of every key (--rank, before they are cached)
+##
+## Usage: python bench/bench_phases.py [size ...]
+##   Sizes are night, week, month and season (default: all of them).
+
+from __future__ import print_function
+
+import imp
+import logging
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'processData-20180516.py')
+processData = imp.load_source('processData', SCRIPT)
+gendata = imp.load_source('gendata', os.path.join(HERE, 'gendata.py'))
+
+# Size name -> gendata.py options.
+SIZES = [
+    ('night', ['--files', '8']),
+    ('week', ['--files', '30']),
+    ('month', ['--files', '120']),
+    ('season', ['--files', '300', '--sessions', '3']),
+]
+
+def loadAll(filenames):
+    allData = []
+    for filename in filenames:
+        file_data, logComment = processData.loadFile(filename)
+        if file_data is not None:
+            allData.append(file_data)
+    return allData
+
+def fingerprintAll(allData):
+    for file_data in allData:
+        for s in file_data['sessions']:
+            for sh in s['sheets']:
+                processData.sheetFingerprint(s['sessionName'], sh)
+
+def compileAll(allData):
+    compiler = processData.Compiler()
+    for file_data in allData:
+        compiler.add(file_data)
+    return compiler
+
+def render(compiler):
+    with open(os.devnull, 'w') as outFile:
+        for key in sorted(compiler.compilation):
+            outFile.write(processData.keyReport(key, compiler.compilation[key]))
+
+def export(compiler, dbName):
+    processData.writeDatabase(compiler, dbName)
+
+def rankAll(compiler):
+    for key in compiler.compilation:
+        processData.Rankings(compiler.compilation[key])
+
+def best(func):
+    return min(timeit.repeat(func, number=1, repeat=3))
+
+def main():
+    names = sys.argv[1:] or [name for name, args in SIZES]
+    logging.basicConfig(stream=sys.stderr, level=logging.CRITICAL)
+
+    print('size,files,sheets,players,ingest (s),dedup (s),compile (s),report (s),export (s),rank (s)')
+    for name, args in SIZES:
+        if name not in names:
+            continue
+        tmpDir = tempfile.mkdtemp()
+        try:
+            filenames = gendata.generate(tmpDir, gendata.parser().parse_args(args))
+            allData = loadAll(filenames)
+            sheets = [sh for file_data in allData for s in file_data['sessions'] for sh in s['sheets']]
+            players = sum(len(sh['playerData']) for sh in sheets)
+            compiler = compileAll(allData)
+
+            ingestTime = best(lambda: loadAll(filenames))
+            dedupTime = best(lambda: fingerprintAll(allData))
+            compileTime = best(lambda: compileAll(allData))
+            reportTime = best(lambda: render(compiler))
+            exportTime = best(lambda: export(compiler, os.path.join(tmpDir, 'export.db')))
+            rankTime = best(lambda: rankAll(compiler))
+        finally:
+            shutil.rmtree(tmpDir)
+        print('{},{},{},{},{:.3f},{:.3f},{:.3f},{:.3f},{:.3f},{:.3f}'.format(
+            name, len(filenames), len(sheets), players, ingestTime, dedupTime, compileTime, reportTime,
+            exportTime, rankTime))
+
+if __name__ == '__main__':
+    main()
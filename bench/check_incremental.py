@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+## Regression check of the incremental Compiler on synthetic data from
+## gendata.py.  Each seed adds a set of tablet files, then edits, removes
+## and adds files as tablets and coaches would, and after every step
+## compares the per-player scores of the incremental compilation with:
+##   fresh     a new Compiler that adds the current files from scratch
+##   expected  scores taken directly from the first copy of each sheet,
+##             which catches players that the compilation loses
+## Station names are ignored, since they depend on the order sheets arrive.
+## Edits move lastRatingsChange forward, as the app does.
+##
+## Usage: python bench/check_incremental.py [--seeds N] [--steps N]
+
+from __future__ import print_function
+
+import argparse
+import copy
+import imp
+import logging
+import os.path
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'processData-20180516.py')
+processData = imp.load_source('processData', SCRIPT)
+gendata = imp.load_source('gendata', os.path.join(HERE, 'gendata.py'))
+
+GENDATA_ARGS = ['--sheets', '3', '--players', '4', '--bad-ids', '0.2', '--repeats', '0.03', '--non-ascii', '0']
+
+# Return {key: {(team, id): sorted scores}} of a compilation.
+def compiledScores(compiler):
+    result = {}
+    for key, store in compiler.compilation.items():
+        for teamKey, idNum, rowNum in store.players():
+            scores = [store.scores(rowNum, station) for station in store.stationList]
+            scores = [(tuple(ratings), total) for ratings, total in filter(None, scores)]
+            if scores:
+                result.setdefault(key, {})[(teamKey, idNum)] = sorted(scores, key=repr)
+    return result
+
+# Return the scores a compilation of files should have: those of the first
+# copy of each sheet, for each player with a numeric id, as first listed in it.
+def expectedScores(files):
+    result = {}
+    fingerprints = set()
+    for filename in sorted(files):
+        for s in files[filename]['sessions']:
+            for sh in s['sheets']:
+                fingerprint = processData.sheetFingerprint(s['sessionName'], sh)
+                if fingerprint in fingerprints:
+                    continue
+                fingerprints.add(fingerprint)
+                key = sh['grade'] + sh['gender'] + sh['eType']
+                sheetScores = processData.scoreSheet(sh['playerData'], sh['categories'])
+                seen = set()
+                for p, (ratings, total, ratingsCount, problems) in zip(sh['playerData'], sheetScores):
+                    player = (p['team'], p['id'])
+                    if not p['id'].isdigit() or player in seen:
+                        continue
+                    seen.add(player)
+                    result.setdefault(key, {}).setdefault(player, []).append((tuple(ratings), total))
+    for players in result.values():
+        for player in players:
+            players[player].sort(key=repr)
+    return result
+
+# Return the first (key, player) whose scores differ, or None.
+def firstDifference(scores, other):
+    for key in sorted(set(scores) | set(other)):
+        players, otherPlayers = scores.get(key, {}), other.get(key, {})
+        for player in sorted(set(players) | set(otherPlayers)):
+            if players.get(player) != otherPlayers.get(player):
+                return key, player
+    return None
+
+class Editor(object):
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.minutes = 0
+
+    # Return a lastRatingsChange later than any before it.
+    def stamp(self):
+        self.minutes += 1
+        return '2018-06-%02dT%02d:%02d' % (1 + self.minutes // 1440, self.minutes // 60 % 24, self.minutes % 60)
+
+    # Return a copy of a file's data with some of its sheets edited.
+    def edit(self, fileData, otherFiles):
+        rnd = self.rnd
+        fileData = copy.deepcopy(fileData)
+        for s in fileData['sessions']:
+            for sh in list(s['sheets']):
+                x = rnd.random()
+                if x < 0.15 and sh['playerData']:
+                    p = rnd.choice(sh['playerData'])
+                    p['ratings'][rnd.choice(sh['categories'])] = rnd.choice(sh['ratingValues'])
+                    p['lastRatingsChange'] = sh['lastRatingsChange'] = self.stamp()
+                elif x < 0.2:
+                    s['sheets'].remove(sh)
+                elif x < 0.25:
+                    sh['comments'] = 'Edited %d' % rnd.randint(0, 99)
+                elif x < 0.3 and sh['playerData']:
+                    sh['playerData'].pop(rnd.randrange(len(sh['playerData'])))
+        # Tablets that sync pick up sessions of other tablets.
+        if otherFiles and rnd.random() < 0.2:
+            fileData['sessions'].append(copy.deepcopy(rnd.choice(rnd.choice(otherFiles)['sessions'])))
+        return fileData
+
+# Run one seed; returns (rebuilds, failure message or None).
+def checkSeed(seed, steps):
+    rnd = random.Random(seed)
+    opts = gendata.parser().parse_args(GENDATA_ARGS)
+    generated = {}
+    previous = None
+    for fileNum in range(6):
+        fileData = gendata.makeFile(rnd, opts, fileNum)
+        if previous and rnd.random() < 0.5:
+            fileData['sessions'].append(copy.deepcopy(previous['sessions'][0]))
+        previous = generated['soccer.%d.txt' % fileNum] = fileData
+    editor = Editor(rnd)
+
+    files = dict(generated)
+    compiler = processData.Compiler(incremental=True)
+    for filename in sorted(files):
+        compiler.add(dict(files[filename], filename=filename))
+    rebuilds = 0
+    for step in range(steps):
+        filename = rnd.choice(sorted(generated))
+        if filename in files and rnd.random() < 0.2:
+            del files[filename]
+            compiler.remove(filename)
+        else:
+            otherFiles = [files[other] for other in sorted(files) if other != filename]
+            files[filename] = editor.edit(files.get(filename, generated[filename]), otherFiles)
+            compiler.add(dict(files[filename], filename=filename))
+        if compiler.needsRebuild:
+            # As watchFolder() does.
+            rebuilds += 1
+            compiler = processData.Compiler(incremental=True)
+            for name in sorted(files):
+                compiler.add(dict(files[name], filename=name))
+
+        fresh = processData.Compiler()
+        for name in sorted(files):
+            fresh.add(dict(files[name], filename=name))
+        scores = compiledScores(compiler)
+        for name, other in [('fresh', compiledScores(fresh)), ('expected', expectedScores(files))]:
+            difference = firstDifference(scores, other)
+            if difference:
+                return rebuilds, 'seed {} step {}: {} differs from {} compilation'.format(
+                    seed, step, difference, name)
+    return rebuilds, None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, default=200)
+    parser.add_argument('--steps', type=int, default=6)
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.CRITICAL)
+
+    failures = rebuilds = 0
+    for seed in range(args.seeds):
+        seedRebuilds, failure = checkSeed(seed, args.steps)
+        rebuilds += seedRebuilds
+        if failure:
+            failures += 1
+            print(failure)
+    print('seeds {}, steps {}, rebuilds {}, failures {}'.format(args.seeds, args.steps, rebuilds, failures))
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
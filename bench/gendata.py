@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+## Synthetic tablet data for benchmarks: writes soccer.N.txt files in the
+## app's JSON format and soccer.N.csv backups in the app's csv backup format.
+##
+## Usage: python bench/gendata.py [options] DIR
+##   See --help for the sizes and the share of duplicates, missing ratings,
+##   non-ascii comments and csv backups.  Csv backups with a non-ascii
+##   comment are rejected by the script, as real ones are.  --bad-ids and
+##   --repeats add players the script must skip or comment on.
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os.path
+import random
+
+GRADES = ['3rd', '4th', '5th', '6th']
+GENDERS = ['Boys', 'Girls']
+ETYPES = ['Night1', 'Night2', 'Bubble']
+TEAMS = ['Green', 'White', 'Red', 'Blue']
+COMMENTS = ['Thanks, so good', 'Late start', 'Rain delay']
+NON_ASCII_COMMENTS = ['Caf\xe9 line\nbreak', '\xbfQui\xe9n falta?', 'Se\xf1or coach']
+
+# Generate the data of one sheet.
+def makeSheet(rnd, opts, grade, gender, eType, field, group):
+    if eType == 'Bubble':
+        categories = ['A']
+        ratingValues = [str(i) for i in range(1, 21)]
+    else:
+        categories = [chr(ord('A') + i) for i in range(opts.categories)]
+        ratingValues = [str(i) for i in range(1, 7)]
+    teams = TEAMS[:opts.teams]
+    playerData = []
+    for team in teams:
+        for idNum in rnd.sample(range(1, opts.players * 4), opts.players):
+            ratings = {}
+            for c in categories:
+                if rnd.random() < opts.missing:
+                    continue
+                ratings[c] = rnd.choice(ratingValues)
+            playerData.append({'team': team,
+                               'id': str(idNum),
+                               'lastRatingsChange': '2018-05-2%dT19:%02d' % (rnd.randint(0, 9), rnd.randint(0, 59)),
+                               'ratings': ratings})
+    # Players to skip: an id that is not a number, and a second listing.
+    if opts.bad_ids and rnd.random() < opts.bad_ids:
+        playerData.insert(rnd.randint(0, len(playerData)),
+                          {'team': rnd.choice(teams), 'id': rnd.choice(['x9', 'abc', '']),
+                           'lastRatingsChange': '2018-05-22T19:00', 'ratings': {}})
+    if opts.repeats and playerData and rnd.random() < opts.repeats:
+        repeat = dict(rnd.choice(playerData), ratings={c: rnd.choice(ratingValues) for c in categories})
+        playerData.insert(rnd.randint(0, len(playerData)), repeat)
+    comments = ''
+    x = rnd.random()
+    if x < opts.non_ascii:
+        comments = rnd.choice(NON_ASCII_COMMENTS)
+    elif x < 0.3:
+        comments = rnd.choice(COMMENTS)
+    return {'sheetName': grade + gender + eType + field + group,
+            'eType': eType,
+            'teams': teams,
+            'grade': grade,
+            'gender': gender,
+            'field': field,
+            'group': group,
+            'comments': comments,
+            'playerData': playerData,
+            'categories': categories,
+            'ratingValues': ratingValues,
+            'ratingTip': '1 - 6',
+            'lastRatingsChange': '2018-05-22T19:00'}
+
+# Generate the data of one tablet file.
+def makeFile(rnd, opts, fileNum):
+    sessions = []
+    for sessionNum in range(opts.sessions):
+        sheets = []
+        for sheetNum in range(opts.sheets):
+            eType = rnd.choice(ETYPES)
+            if eType == 'Bubble':
+                field = rnd.choice(['', 'Field1', 'Field2'])
+            else:
+                field = 'Station%d' % rnd.randint(1, 6)
+            sheets.append(makeSheet(rnd, opts, rnd.choice(GRADES), rnd.choice(GENDERS), eType,
+                                    field, rnd.choice(['', 'Group1', 'Group2'])))
+        sessions.append({'sessionName': '05%02d_6-8pm' % (19 + sessionNum + fileNum % 7),
+                         'lastRatingsChange': '2018-05-22T19:00',
+                         'sheets': sheets})
+    return {'version': 201610,
+            'lastRatingsChange': '2018-05-22T19:00',
+            'deviceInfo': {'uuid': 'tablet%d' % fileNum, 'platform': 'Android'},
+            'sessions': sessions}
+
+# Return the app's csv backup of a file's data.
+def toCsv(fileData):
+    lines = ['Csv backup of soccer.txt,', ',From device,']
+    for k in sorted(fileData['deviceInfo']):
+        lines.append(',,%s,"%s",' % (k, fileData['deviceInfo'][k]))
+    lines += [',Schema version,%s,' % fileData['version'],
+              ',Last ratings change,%s,' % fileData['lastRatingsChange'], ',']
+    for s in fileData['sessions']:
+        lines += ['Session Data,', ',sessionName,%s,' % s['sessionName'],
+                  ',Last ratings change,%s,' % s['lastRatingsChange'], ',']
+        for sh in s['sheets']:
+            lines.append(',Sheet Data,')
+            for k in ['sheetName', 'eType', 'teams', 'grade', 'gender', 'field', 'group', 'comments',
+                      'categories', 'ratingValues', 'ratingTip', 'lastRatingsChange']:
+                v = sh[k]
+                if isinstance(v, list):
+                    v = ','.join(v)
+                lines.append(',,%s,"%s",' % (k, v.replace('\n', ' ')))
+            lines.append(','.join(['sessionName', 'sheetName', 'team', 'id'] + sh['categories'] +
+                                  ['lastRatingsChange']) + ',')
+            for p in sh['playerData']:
+                lines.append(','.join([s['sessionName'], sh['sheetName'], p['team'], p['id']] +
+                                      [p['ratings'].get(c, '') for c in sh['categories']] +
+                                      [p['lastRatingsChange']]) + ',')
+            lines.append(',')
+        lines.append(',')
+    return '\r\n'.join(lines) + '\r\n'
+
+# Write the files; returns their names.
+def generate(outDir, opts):
+    rnd = random.Random(opts.seed)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    filenames = []
+    previous = None
+    for fileNum in range(opts.files):
+        fileData = makeFile(rnd, opts, fileNum)
+        # Tablets that sync resend sessions that are already in an earlier file.
+        if previous and rnd.random() < opts.duplicates:
+            fileData['sessions'].append(previous['sessions'][0])
+        previous = fileData
+        filename = os.path.join(outDir, 'soccer.%d.txt' % fileNum)
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(fileData, ensure_ascii=False))
+        filenames.append(filename)
+        if rnd.random() < opts.csv:
+            filename = os.path.join(outDir, 'soccer.%d.csv' % fileNum)
+            with io.open(filename, 'w', encoding='utf-8', newline='') as f:
+                f.write(toCsv(fileData))
+            filenames.append(filename)
+    return filenames
+
+def parser():
+    parser = argparse.ArgumentParser(description='Write synthetic tablet files')
+    parser.add_argument('--files', type=int, default=10, help='Tablet files (default 10)')
+    parser.add_argument('--sessions', type=int, default=2, help='Sessions per file (default 2)')
+    parser.add_argument('--sheets', type=int, default=4, help='Sheets per session (default 4)')
+    parser.add_argument('--teams', type=int, default=2, choices=range(1, len(TEAMS) + 1),
+                        help='Teams per sheet (default 2)')
+    parser.add_argument('--players', type=int, default=8, help='Players per team (default 8)')
+    parser.add_argument('--categories', type=int, default=3, help='Categories of non-Bubble sheets (default 3)')
+    parser.add_argument('--duplicates', type=float, default=0.3,
+                        help='Share of files that repeat a session of the previous file (default 0.3)')
+    parser.add_argument('--missing', type=float, default=0.05, help='Share of missing ratings (default 0.05)')
+    parser.add_argument('--non-ascii', type=float, default=0.05, dest='non_ascii',
+                        help='Share of sheets with a non-ascii comment (default 0.05)')
+    parser.add_argument('--bad-ids', type=float, default=0, dest='bad_ids',
+                        help='Share of sheets with a player whose id is not a number (default 0)')
+    parser.add_argument('--repeats', type=float, default=0,
+                        help='Share of sheets that list a player twice (default 0)')
+    parser.add_argument('--csv', type=float, default=0.5,
+                        help='Share of files that also get a csv backup (default 0.5)')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser
+
+def main():
+    p = parser()
+    p.add_argument('dir', help='Folder to write the files to')
+    opts = p.parse_args()
+    filenames = generate(opts.dir, opts)
+    print('Wrote {} files to {}'.format(len(filenames), opts.dir))
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,50 @@
 ## See Notes at bottom for setup.
 
 import argparse
+import array
+import BaseHTTPServer
 import bisect
+import codecs
+import cProfile
 import csv        
+import cStringIO
 import glob
+import hashlib
+import heapq
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os.path
 import pprint
+import re
+import SocketServer
+import sqlite3
 import sys
+import tarfile
+import threading
+import time
+import types
+import urllib
+import zipfile
 #import pdb #pdb.set_trace()
-
-SCRIPTNAME = os.path.basename(sys.argv[0])
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # Python 2 without the pytracemalloc backport
+    tracemalloc = None
+
+# Named after the script, also when it is imported by another program.
+if __name__ == '__main__':
+    SCRIPTNAME = os.path.basename(sys.argv[0])
+else:
+    SCRIPTNAME = os.path.basename(__file__)
 LOGNAME = os.path.splitext(SCRIPTNAME)[0] + '.log'
+CACHENAME = os.path.splitext(SCRIPTNAME)[0] + '.cache'
 
 # Logging levels (least to most verbose):
 _LOGGING_LEVELS = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
@@ -65,13 +97,43 @@ def listRStrip(aList):
         aList.pop()
 
 # Write to log when the rest of a row is ignored.
-def logIfRemainder(aList,indx,msgPrefix):
+def logIfRemainder(aList,indx,logWhere):
     if indx < len(aList):
-        logging.warning("{} Ignoring cells {}".format(msgPrefix,aList[indx:]))
+        logging.warning("%s: Ignoring cells %s", logWhere,aList[indx:])
 def ignoredCellsWarning(logWhere,cells):
     if cells:
-        logging.warning("{} Ignoring cells {}".format(logWhere,cells))
+        logging.warning("%s Ignoring cells %s", logWhere,cells)
     
+# Location of a log message: file and csv row, or file, session, sheet
+# and player (team, id).
+# Passed to logging as a %s argument, so it is only rendered when a record is
+# actually emitted; at the default WARNING level the per-row and per-player
+# debug and info messages cost no string formatting.
+class LogWhere(object):
+    __slots__ = ('filename','row','session','sheet','player')
+
+    def __init__(self, filename, row=None, session=None, sheet=None, player=None):
+        self.filename = filename
+        self.row = row
+        self.session = session
+        self.sheet = sheet
+        self.player = player
+
+    def __str__(self):
+        where = "File {}".format(self.filename)
+        if self.row is not None:
+            where += ": Row {}".format(self.row)
+        if self.session is not None:
+            where += ": Session {}".format(self.session)
+        if self.sheet is not None:
+            where += ": Sheet {}".format(self.sheet)
+        if self.player is not None:
+            where += ": Player {}{}".format(*self.player)
+        return where
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
 # Return starting index of "team","id",<categories> headings.
 # Headings must be in the order "team", "id", <categories>.
 # But check for categories after, since that is where error message will be sent.
@@ -83,726 +145,2564 @@ def getHeadingIndex(row):
     else:
         return -1
 
+# Rewrite a decoded json value so that dumping it is canonical.
+# Dicts become [0,[key,value]...] in key order and lists become [1,...],
+# which lets the C encoder do the work (sort_keys forces the slow
+# pure-python encoder) while keeping dicts and lists apart.
+def canonicalValue(obj):
+    t=type(obj)
+    if t is dict:
+        return [0]+[[k,canonicalValue(obj[k])] for k in sorted(obj)]
+    if t is list:
+        return [1]+[canonicalValue(v) for v in obj]
+    return obj
+
+# Return a canonical content fingerprint of a session:sheet.
+# Covers the sheet keys, playerData and ratings, so two sheets share
+# a fingerprint exactly when they hold the same data.
+def sheetFingerprint(sName,sh):
+    canonical=json.dumps(canonicalValue([sName,sh]),separators=(',',':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+# Decide the format of a data file from its leading bytes.
+# The app's soccer.txt is a JSON object and its backup starts with
+# "Csv backup of soccer.txt"; hand-made csv files may start with any keyword,
+# so any other text is treated as csv.
+def sniffFormat(data):
+    if not data.strip() or '\0' in data:
+        return "undefined"
+    if data.lstrip().startswith('{'):
+        return "json"
+    return "csv"
+
 def sheetDefined(sheet):
     if sheet['grade'] and sheet['gender'] and sheet['eType']:
         return True
     else:
         return False
+
+# The parts of the app's data model that the compilation relies on.
+# Loaded files are checked against FILE_SCHEMA before they are compiled.
+# Only values the compilation would fail on are checked; a player id that is
+# not a number, for example, only skips that player.
+# In a schema:
+#   a type or tuple of types  the value is an instance of one of them
+#   object                    any value
+#   [schema]                  a list whose items match schema
+#   {type: schema}            an object whose values match schema
+#   {key: schema, ...}        an object with these keys; a key ending in '?' may be missing
+TEXT = basestring
+PLAYER_SCHEMA = {'team': TEXT, 'id': object, 'ratings': {TEXT: object}}
+SHEET_SCHEMA = {'sheetName': TEXT, 'eType': TEXT, 'grade': TEXT, 'gender': TEXT,
+                'field': TEXT, 'group': TEXT, 'comments': TEXT, 'categories': [TEXT],
+                'ratingValues': list, 'playerData': [PLAYER_SCHEMA]}
+SESSION_SCHEMA = {'sessionName': TEXT, 'sheets': [SHEET_SCHEMA]}
+FILE_SCHEMA = {'sessions': [SESSION_SCHEMA]}
+
+# Names of json value types in problem messages.
+_TYPE_NAMES = [(TEXT, 'text'), (bool, 'true/false'), ((int, long), 'a whole number'),
+               (float, 'a decimal number'), (list, 'a list'), (dict, 'an object'), (type(None), 'null'),
+               (types.GeneratorType, 'a list')]
+
+def typeName(value):
+    return next((name for t, name in _TYPE_NAMES if isinstance(value, t)), type(value).__name__)
+
+# Return the types a schema that only checks a type accepts, or None.
+def leafTypes(schema):
+    if isinstance(schema, (type, tuple)) and schema is not object:
+        return schema
+    if isinstance(schema, dict) and schema.values() == [object] and not isinstance(schema.keys()[0], basestring):
+        return dict
+    return None
+
+# Build a validator from a schema: a function check(value) that returns the
+# (path, message) of each part of value that does not match, or None if all
+# of it does.  A path is the tuple of keys and indexes leading to the part.
+# Returns None for object, which needs no check.
+def compileSchema(schema):
+    if schema is object:
+        return None
+    if leafTypes(schema):
+        schema = leafTypes(schema)
+
+    if isinstance(schema, list):
+        checkItem = compileSchema(schema[0])
+        def check(value):
+            if type(value) is not list:
+                return [((), 'is {}, not a list'.format(typeName(value)))]
+            problems = None
+            if checkItem:
+                for index, item in enumerate(value):
+                    itemProblems = checkItem(item)
+                    if itemProblems:
+                        problems = (problems or []) + [((index,) + path, message) for path, message in itemProblems]
+            return problems
+        return check
+
+    if isinstance(schema, dict):
+        if len(schema) == 1 and not isinstance(schema.keys()[0], basestring):
+            checkValue = compileSchema(schema.values()[0])
+            fields = None
+        else:
+            # Type checks are made inline; the validator of a field is only
+            # called for nested schemas and to report a wrong type.
+            fields = [(key.rstrip('?'), key.endswith('?'), compileSchema(fieldSchema), leafTypes(fieldSchema))
+                      for key, fieldSchema in sorted(schema.items())]
+        def check(value):
+            if type(value) is not dict:
+                return [((), 'is {}, not an object'.format(typeName(value)))]
+            problems = None
+            if fields is None:
+                if checkValue:
+                    for key, item in value.iteritems():
+                        itemProblems = checkValue(item)
+                        if itemProblems:
+                            problems = (problems or []) + [((key,) + path, message) for path, message in itemProblems]
+                return problems
+            for key, optional, checkField, fieldTypes in fields:
+                if key in value:
+                    if fieldTypes and isinstance(value[key], fieldTypes) or not checkField:
+                        continue
+                    itemProblems = checkField(value[key])
+                    if itemProblems:
+                        problems = (problems or []) + [((key,) + path, message) for path, message in itemProblems]
+                elif not optional:
+                    problems = (problems or []) + [((key,), 'is missing')]
+            return problems
+        return check
+
+    expected = []
+    for t in (schema if isinstance(schema, tuple) else (schema,)):
+        name = next((name for t2, name in _TYPE_NAMES if issubclass(t, t2)), t.__name__)
+        if name not in expected:
+            expected.append(name)
+    expected = ' or '.join(expected)
+    def check(value):
+        if not isinstance(value, schema):
+            return [((), 'is {}, not {}'.format(typeName(value), expected))]
+        return None
+    return check
+
+checkFile = compileSchema(FILE_SCHEMA)
+checkSheet = compileSchema(SHEET_SCHEMA)
+# Streamed files are checked a session and a sheet at a time.
+checkStreamedFile = compileSchema(dict(FILE_SCHEMA, sessions=object))
+checkStreamedSession = compileSchema(dict(SESSION_SCHEMA, sheets=(list, types.GeneratorType)))
+
+# Return the log message for a quarantined session (sheet None) or sheet.
+def quarantineMessage(filename, session, sheet, problems):
+    def name(obj, key):
+        if isinstance(obj, dict) and isinstance(obj.get(key), basestring):
+            return obj[key]
+        return '?'
+    logWhere = LogWhere(filename, session=name(session, 'sessionName'),
+                        sheet=None if sheet is None else name(sheet, 'sheetName'))
+    return '{}: Quarantined - {}'.format(logWhere, problemText(problems))
+
+# Join (path, message) problems into one line, with paths like playerData[3].id.
+def problemText(problems):
+    texts = []
+    for path, message in problems:
+        where = ''
+        for part in path:
+            if isinstance(part, int):
+                where += '[{}]'.format(part)
+            else:
+                where += ('.' if where else '') + part
+        texts.append(where + ' ' + message if where else message)
+    return '; '.join(texts)
+
+# Check a loaded file against FILE_SCHEMA in one pass, and drop (quarantine)
+# the sessions and sheets that do not match.  A log message for each is
+# kept in file_data['quarantined'], so that the Compiler reports them even
+# when the file comes from the parse cache.
+# Returns a message if the file itself does not match, else None.
+def quarantine(file_data):
+    problems = checkFile(file_data)
+    if not problems:
+        return None
+    fileProblems = [(path, message) for path, message in problems if len(path) < 2 or path[0] != 'sessions']
+    if fileProblems:
+        return '{}: Is not a valid data file - {}'.format(LogWhere(file_data['filename']), problemText(fileProblems))
+
+    # Group the problems by session, or by (session, sheet).
+    bad = {}
+    for path, message in problems:
+        if 4 <= len(path) and path[2] == 'sheets':
+            bad.setdefault((path[1], path[3]), []).append((path[4:], message))
+        else:
+            bad.setdefault(path[1], []).append((path[2:], message))
+
+    sessions = file_data['sessions']
+    quarantined = []
+    for unit in sorted(bad):
+        if isinstance(unit, int):
+            quarantined.append(quarantineMessage(file_data['filename'], sessions[unit], None, bad[unit]))
+        elif unit[0] not in bad:
+            s = sessions[unit[0]]
+            quarantined.append(quarantineMessage(file_data['filename'], s, s['sheets'][unit[1]], bad[unit]))
+    for sIndex, s in enumerate(sessions):
+        if sIndex not in bad:
+            s['sheets'] = [sh for shIndex, sh in enumerate(s['sheets']) if (sIndex, shIndex) not in bad]
+    file_data['sessions'] = [s for sIndex, s in enumerate(sessions) if sIndex not in bad]
+    file_data['quarantined'] = quarantined
+    return None
+
+# Yield the sheets of a streamed session that match SHEET_SCHEMA,
+# quarantining the others.
+def checkedSheets(sheets, filename, session, quarantined):
+    for sh in sheets:
+        problems = checkSheet(sh)
+        if problems:
+            quarantined.append(quarantineMessage(filename, session, sh, problems))
+        else:
+            yield sh
     
-# Process arguments
-# Could use type=argparse.FileType('r'), but need to easily get list of filenames.
-parser = argparse.ArgumentParser()
-parser.add_argument('files',
-                    nargs='+',
-                    help='JSon or csv files containing evaluation data')
-parser.add_argument('--log-level',
-                    default='WARNING',
-                    dest='log_level',
-                    choices=_LOGGING_LEVELS,
-                    nargs='?',
-                    help='Set the logging output level')
-#parser.add_argument("--pdb", default=False)
-args = parser.parse_args()
-
-# Configure logging
-logging.basicConfig(filename=LOGNAME, filemode='w', level=args.log_level)
-logging.info('Argument List: %s', str(sys.argv))
-
-# Handle file wildcards
-gfilelist = []
-for argf in args.files:
-    for globargf in glob.glob(argf):
-        gfilelist.append(globargf)
-        
-# Remove duplicates and sort the list of files.
-filelist = sorted(list(set(gfilelist)))
-logging.info('Files (%s): %s', len(filelist), filelist)
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Cursor over a JSON buffer for parsing it one value at a time.
+class JsonStream(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.error = None
+
+    # Skip whitespace and return the next character, or '' at the end.
+    def peek(self):
+        self.pos = _JSON_WHITESPACE.match(self.data, self.pos).end()
+        return self.data[self.pos:self.pos+1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expecting '{}': char {}".format(char, self.pos))
+        self.pos += 1
+
+    # Decode the next complete value.
+    def value(self):
+        self.peek()
+        value, self.pos = _JSON_DECODER.raw_decode(self.data, self.pos)
+        return value
+
+    # Iterate over the keys of an object; the caller consumes each value.
+    def members(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+    # Iterate over the elements of an array; the caller consumes each one.
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    # Report a syntax error found while streaming; only the first is reported.
+    def fail(self, logWhere, e):
+        if not self.error:
+            self.error = "{}: Is not a valid json file - {}".format(logWhere,e)
+            logging.error(self.error)
+            print "ERROR:",self.error
+
+# Archives whose members are read as data files, by lower-case extension.
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2')
+# Errors from reading a damaged or missing archive or member.
+ARCHIVE_ERRORS = (IOError, OSError, EOFError, KeyError, zipfile.BadZipfile, tarfile.TarError)
+
+# Member data of each tar archive read so far, by archive name.
+# Compressed tars cannot seek to a member cheaply, so each is read once.
+_tarMembers = {}
+
+def isArchive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+# Return the sorted names of the data files in an archive.
+# Folders and the "._" files and __MACOSX folder added by Mac zipping are left out.
+def listArchive(archive):
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zipArchive:
+            names = [info.filename for info in zipArchive.infolist() if not info.filename.endswith('/')]
+    else:
+        names = list(readTarMembers(archive))
+    return sorted(name for name in names
+                  if not name.startswith('__MACOSX/') and not os.path.basename(name).startswith('._'))
+
+def readTarMembers(archive):
+    if archive not in _tarMembers:
+        members = {}
+        tarArchive = tarfile.open(archive)
+        try:
+            for info in tarArchive:
+                if info.isfile():
+                    members[info.name] = tarArchive.extractfile(info).read()
+        finally:
+            tarArchive.close()
+        _tarMembers[archive] = members
+    return _tarMembers[archive]
+
+# Split the name of an archive member, "<archive>/<member>", into
+# (archive, member), or return None if filename is not an archive member.
+def splitArchiveMember(filename):
+    lower = filename.lower()
+    for extension in ARCHIVE_EXTENSIONS:
+        end = lower.find(extension + '/')
+        while end != -1:
+            archive = filename[:end + len(extension)]
+            if os.path.isfile(archive):
+                return archive, filename[len(archive) + 1:]
+            end = lower.find(extension + '/', end + 1)
+    return None
+
+# Replace the archives in filelist by their members, named "<archive>/<member>".
+# Archives that cannot be read are reported and left out.
+def expandArchives(filelist):
+    expanded = []
+    for filename in filelist:
+        if not isArchive(filename):
+            expanded.append(filename)
+            continue
+        try:
+            members = listArchive(filename)
+        except ARCHIVE_ERRORS as e:
+            logComment = "{}: Could not be read - {}".format(LogWhere(filename),e)
+            logging.error(logComment)
+            print "ERROR:",logComment
+            continue
+        logging.info('%s: Archive with %s files', LogWhere(filename), len(members))
+        expanded += [filename + '/' + member for member in members]
+    return expanded
+
+# Data files found when scanning a folder, by lower-case extension.
+DATA_EXTENSIONS = ('.txt', '.csv', '.json') + ARCHIVE_EXTENSIONS
+
+# Replace the folders in filelist by the data files in them and their subfolders.
+# os.walk() lists folders with os.scandir() where python has it.
+def expandFolders(filelist):
+    expanded = []
+    for filename in filelist:
+        if not os.path.isdir(filename):
+            expanded.append(filename)
+            continue
+        for folder, subfolders, names in os.walk(filename):
+            subfolders.sort()
+            expanded += [os.path.join(folder, name) for name in sorted(names)
+                         if name.lower().endswith(DATA_EXTENSIONS)]
+    return expanded
+
+# Return the sha1 of the contents of a file or an archive member.
+def contentHash(filename):
+    if '/' in filename and splitArchiveMember(filename):
+        return hashlib.sha1(readData(filename)).hexdigest()
+    digest = hashlib.sha1()
+    with open(filename,'rb') as tablet_file:
+        for chunk in iter(lambda: tablet_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Return filelist without the files that are byte-identical copies of an
+# earlier file, e.g. the same export saved as soccer.txt and soccer (1).txt,
+# and {filename: sha1} of the files kept, for loadFiles().
+# Files that cannot be read are kept, to be reported when they are loaded.
+# With the parse cache, files that did not change since they were cached
+# take the hash recorded there and are not read.
+def uniqueFiles(filelist, cache=None):
+    firstFiles = {}
+    unique = []
+    digests = {}
+    for filename in filelist:
+        try:
+            digest = (cache and cachedHash(cache, filename)) or contentHash(filename)
+        except ARCHIVE_ERRORS:
+            unique.append(filename)
+            continue
+        if digest in firstFiles:
+            logging.warning('%s: Skipping since it is a copy of file %s.', LogWhere(filename),firstFiles[digest])
+        else:
+            firstFiles[digest] = filename
+            unique.append(filename)
+            digests[filename] = digest
+    return unique, digests
+
+# Return the contents of a file or an archive member.
+def readData(filename):
+    archiveMember = splitArchiveMember(filename) if '/' in filename else None
+    if archiveMember is None:
+        with open(filename,'rb') as tablet_file:
+            return tablet_file.read()
+    archive, member = archiveMember
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zipArchive:
+            return zipArchive.read(member)
+    return readTarMembers(archive)[member]
+
+# Read a file, or an archive member, into a buffer.
+# Returns (data, None), or (None, logComment) if the file cannot be read.
+def readFile(filename):
+    try:
+        data = readData(filename)
+    except ARCHIVE_ERRORS as e:
+        return None, "{}: Could not be read - {}".format(LogWhere(filename),e)
+    return stripBom(data), None
+
+# Remove the UTF-8 byte order mark some editors write at the start of a file.
+def stripBom(data):
+    if data.startswith(codecs.BOM_UTF8):
+        return data[len(codecs.BOM_UTF8):]
+    return data
+
+# The sheets to compile, from the --key, --grade, --gender and --etype options.
+# Each is a list of accepted values, or None to accept any value.
+class SheetFilter(object):
+    def __init__(self, keys=None, grades=None, genders=None, eTypes=None):
+        self.keys = keys
+        self.grades = grades
+        self.genders = genders
+        self.eTypes = eTypes
+
+    def matches(self, sheet):
+        grade = sheet.get('grade', '')
+        gender = sheet.get('gender', '')
+        eType = sheet.get('eType', '')
+        return ((self.keys is None or grade + gender + eType in self.keys) and
+                (self.grades is None or grade in self.grades) and
+                (self.genders is None or gender in self.genders) and
+                (self.eTypes is None or eType in self.eTypes))
+
+# Read a file,
+# determine the type and put non-JSON files into the JSON format of the app datafile.
+# Returns (file_data, None), or (None, logComment) if the file is not valid.
+# With a SheetFilter, the csv player data of other sheets is skipped.
+def loadFile(filename, sheetFilter=None):
+    data, logComment = readFile(filename)
+    if data is None:
+        return None, logComment
+    return parseData(filename, data, sheetFilter)
+
+# Reader of the app's csv backup: a state machine over its rows.
+#   START    before the first sessionName row
+#   SESSION  in a session, before its first sheetName row
+#   SHEET    defining a sheet: after its sheetName row, before its player data
+#   PLAYERS  in the player data section, after the "team","id",<categories> headings
+# A row whose first cell is a keyword is handled by the KEYWORDS method for it;
+# any other row is player data in the PLAYERS state and ignored otherwise.
+# Methods return False when the file is not valid.
+# The player data of sheets that sheetFilter does not match is skipped.
+class CsvBackupParser(object):
+    START, SESSION, SHEET, PLAYERS = range(4)
+
+    # Sheet keys
+    sheetKeysStr=["eType","grade","gender","field","group","comments","ratingTip","lastRatingsChange"]
+    sheetKeysList=["teams","categories","ratingValues"]
+
+    def __init__(self, filename, sheetFilter=None):
+        self.filename = filename
+        self.sheetFilter = sheetFilter
+        self.logWhere = LogWhere(filename)
+        self.file_data = {"version": "", "sessions": []}
 
-# Define patterns for processing the player id (in csv and excel files).
-leadingChars="^[a-z,A-Z]*"
-endingNums="[0-9]*$"
+        # Set initial values
+        self.state = self.START
+        self.sessionSelected = {}
+        self.sheetSelected = {}
+        self.playerDataColumn = -1
+        self.playerTeam = "UNSET"
+        self.skipPlayers = False
+
+        # Level guard for the per-row debug messages.
+        self.logDebug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def parse(self, data):
+        # Don't try to handle non-ascii data.
+        # App should prevent it but currently allows non-ascii in comments and ratingTip.
+        # If the whole buffer is ascii and every \r ends a line, a cell can only hold a
+        # line break if its row spans lines, or if it is the last cell and an unclosed
+        # quote ran to the end of the file; the cells only need checking otherwise.
+        try:
+            data.decode('ascii')
+        except UnicodeDecodeError:
+            checkCells = True
+        else:
+            checkCells = data.count('\r') != data.count('\r\n')
 
-# Read each file,
-# determine the type and put non-JSON files into the JSON format of the app datafile.
-#
-# Then process all of the data into a single dictionary structure for printing.
-#{
-#  '6thGirlsNight1': {
-#    'kComments': [
-#      'File soccer.1.68.txt: Session 0522_6-8pm: Sheet 6thGirlsNight1Station5Group3: Has comment - Thanks so'
-#    ],
-#    'data': {
-#      'White': {
-#        '38': {
-#          'Station5': {
-#            'ratings': {'A':'', 'B':''},
-#            'total': 0
-#          },
-#          'pComments': 'In station Station5 but with no ratings. '
-#        },
-#      },
-#      'Green': {
-#        '34': {
-#          'Station5': {
-#            'ratings': {'A':4, 'B':4},
-#            'total': 8
-#          }
-#        },
-#      }
-#    },
-#    'categories': ['A','B'],
-#    'stationList': ['Station5']
-#  }
-#}
-#
-# When processed, team values ("Green", "White", "Red", or "Blue")
-#   will be changed to "g", w", "r", "b".                                      
+        reader = csv.reader(io.BytesIO(data))
+        lineNum = 0
+        for rowIndex, row in enumerate(reader):
+            logWhere = self.logWhere = LogWhere(self.filename,row=rowIndex+1)
+            #logging.debug("%s: row=%s", logWhere,row)
+
+            if checkCells:
+                badCells = any(isNonAsciiCRLF(item) for item in row)
+            else:
+                badCells = reader.line_num != lineNum + 1 or (row and '\n' in row[-1])
+            lineNum = reader.line_num
+            if badCells:
+                logging.error("%s: Data files cannot contain non-ascii data", logWhere)
+                return False
+
+            # Strip each item in the row,
+            # String trailing cells that have only whitespace
+            # Skip empty rows
+            row=[item.strip() for item in row]
+            listRStrip(row)
+            if not row:
+                continue
+
+            # Find first non-empty cellIndex, cellValue.
+            # One always exists due to skipping of empty rows above.
+            cellIndex = next((indx for indx, val in enumerate(row) if val))
+            cellValue = row[cellIndex]
+
+            # Skip lastRatingsChange, except that of a sheet.
+            if cellValue == "lastRatingsChange" and self.state != self.SHEET:
+                continue
+
+            # Player data column headings in a role override any leading keywords (e.g., sessionName),
+            # so we check for that first.
+            rowHeadingIndex = getHeadingIndex(row) if "team" in row else -1
+            if 0 < rowHeadingIndex:  # Row contains column headings for player data section
+                valid = self.headings(row,rowHeadingIndex,logWhere)
+            elif cellValue in self.KEYWORDS:
+                valid = self.KEYWORDS[cellValue](self,row,cellIndex,cellValue,logWhere)
+            elif self.state == self.PLAYERS:
+                valid = self.player(row,logWhere)
+            else:
+                logging.warning("%s: No useful data found in %s", logWhere,row)
+                valid = True
+            if not valid:
+                return False
+        return True
+
+    # Record the last session and sheet.
+    def finish(self):
+        logWhere = self.logWhere
+        if self.sheetSelected:
+            self.sessionSelected["sheets"].append(self.sheetSelected);
+            logging.debug("%s: Appended sheet %s to session %s",
+                logWhere,self.sheetSelected["sheetName"],self.sessionSelected["sessionName"])
+        if self.sessionSelected:
+            self.file_data["sessions"].append(self.sessionSelected);
+            logging.debug("%s: Appended session %s to file_data",
+                logWhere,self.sessionSelected["sessionName"])
+
+    def headings(self, row, rowHeadingIndex, logWhere):
+        sheetSelected = self.sheetSelected
+        if self.state == self.SHEET and sheetDefined(sheetSelected):  # Entering player data section
+            # Record index of "team" heading.
+            self.playerDataColumn=rowHeadingIndex
+            self.state = self.PLAYERS
+            self.skipPlayers = self.sheetFilter is not None and not self.sheetFilter.matches(sheetSelected)
+
+            # Check and set categories; remove last item if "lastRatingsChange"
+            categories=row[self.playerDataColumn+2:]
+            if categories[-1] == "lastRatingsChange":
+                categories = categories[:-1]
+
+            if not categories:
+                logging.error("%s: Player data column headings are missing categories", logWhere)
+                return False
+
+            if sheetSelected["categories"]:
+                if sheetSelected["categories"] != categories:
+                    logging.error("%s: Categories definitions do not match", logWhere)
+                    logging.error(categories[-1])
+                    return False
+            else:
+                sheetSelected["categories"] = categories
+
+            logging.debug("%s: Set playerData start index", logWhere)
+            # TODO: Warn if ignoring cells before playerDataColumn aList[start:end]
+            #ignoredCellsWarning(logWhere,row[:playerDataColumn])
+
+        elif self.state != self.PLAYERS or not sheetDefined(sheetSelected):
+            logging.error("%s: SheetName must be defined (sheetname, eType, grade, gender) before player data section", logWhere)
+            return False
+
+        else: # Already in player data section
+            logging.warning("%s: Ignoring player data heading inside player data section", logWhere)
+        return True
+
+    def version(self, row, cellIndex, cellValue, logWhere):
+        if self.file_data["version"]:
+            logging.warning("%s: Warning: version already set", logWhere)
+        else:
+            # Record app version.
+            # Ignore remainder of row.
+            self.file_data["version"]=listGet(row,cellIndex+1,0)
+            logIfRemainder(row,cellIndex+2,logWhere)
+        return True
+
+    def sessionName(self, row, cellIndex, cellValue, logWhere):  # Entering defining-session section
+        # Save current data and start a new session.
+        self.finish()
+        self.sessionSelected={"sessionName":"" ,"sheets":[]}
+        self.sheetSelected={}
+        self.state = self.SESSION
 
-# Collect the data as a list of dictionaries,
-# one dictionary for each valid file.
-logging.info("=== Collecting data from files...")
-allData = []
+        self.playerDataColumn=-1
+        self.playerTeam="UNSET"
 
-for filenum in range(len(filelist)):
-    tabletFile = filelist[filenum]   
+        # Record session name.
+        # Ignore remainder of row.
+        self.sessionSelected["sessionName"]=listGet(row,cellIndex+1,"UNSET")
+        logIfRemainder(row,cellIndex+2,logWhere)
+        return True
+
+    def sheetName(self, row, cellIndex, cellValue, logWhere):  # Entering defining-sheet section
+        # Create new session, if necessary.
+        if not self.sessionSelected["sessionName"]:
+            self.sessionSelected={"sessionName":"Default" ,"sheets":[]}
+            logging.info("%s: Sheet not in a session; defined default session", logWhere)
+
+        # Save current data and start a new sheet.
+        if self.sheetSelected:
+            self.sessionSelected["sheets"].append(self.sheetSelected);
+            logging.debug("%s: Appended sheet %s to session %s",
+                logWhere,self.sheetSelected["sheetName"],self.sessionSelected["sessionName"])
+        self.sheetSelected={"sheetName":"","eType":"","teams":[],"grade":"","gender":"",
+           "field":"","group":"","comments":"","playerData":[],"categories":[],
+           "ratingValues":[],"ratingTip":"","lastRatingsChange":""}
+        self.state = self.SHEET
+
+        self.playerDataColumn=-1
+        self.playerTeam="UNSET"
+
+        # Record sheet name.
+        # Ignore remainder of row.
+        self.sheetSelected["sheetName"]=listGet(row,cellIndex+1,"UNSET")
+        logIfRemainder(row,cellIndex+2,logWhere)
+        return True
+
+    def sheetKey(self, row, cellIndex, cellValue, logWhere):
+        if self.state == self.SHEET: # In defining-sheet section
+            # Record property.
+            # Ignore remainder of row.
+            value=listGet(row,cellIndex+1,"")
+            if cellValue in self.sheetKeysList:
+                value=value.split(',')
+            self.sheetSelected[cellValue]=value
+            logIfRemainder(row,cellIndex+2,logWhere)
+            logging.debug("%s: Recorded %s in sheet %s", logWhere,cellValue,self.sheetSelected["sheetName"])
+
+        elif self.state != self.PLAYERS:
+            logging.error("%s: SheetName must be set before sheet keys", logWhere)
+            return False
+
+        else:
+            logging.error("%s: When starting a new sheet, sheetName must be set before sheet keys", logWhere)
+            return False
+        return True
+
+    def player(self, row, logWhere):
+        if self.skipPlayers:
+            return True
+        playerDataColumn = self.playerDataColumn
+        # Get team and id values
+        teamVal=""
+        idVal=""
+        if -1 < playerDataColumn < len(row):
+            teamVal=row[playerDataColumn]
+        if -1 < playerDataColumn+1 < len(row):
+            idVal=row[playerDataColumn+1]
+
+        # If value in team column, set team.
+        # Team initally ="UNSET" and can be inherited from previous row, but Id cannot.
+        if teamVal or idVal:
+            if teamVal:
+                self.playerTeam=teamVal
+            else:
+                logging.info("%s: No team so using previous value", logWhere)
+
+            if idVal:
+                playerId=idVal
+
+                # Record ratings if non-empty TODO: should it record if empty?  What does app do?
+                ratings={}
+                for catIndex, cat in enumerate(self.sheetSelected["categories"]):
+                    ratingIndex=playerDataColumn+2+catIndex
+                    if ratingIndex < len(row) and row[ratingIndex]:
+                        ratings[cat]=row[ratingIndex]
+                self.sheetSelected["playerData"].append({"team":self.playerTeam,"id":playerId,"ratings":ratings})
+                if self.logDebug:
+                    logging.debug("%s: Appended player data to sheet %s", logWhere,self.sheetSelected["sheetName"])
+            else:
+                logging.info("%s: No id so only recording team", logWhere)
+
+        else:
+            logging.debug("%s: Neither team nor id values found in %s", logWhere,row)
+        return True
+
+    KEYWORDS = dict.fromkeys(sheetKeysStr + sheetKeysList, sheetKey)
+    KEYWORDS.update(version=version, sessionName=sessionName, sheetName=sheetName)
+
+# Parse the contents of a file read by readFile(); see loadFile().
+def parseData(filename, data, sheetFilter=None):
+    tabletFile = filename
     tabletFileType = "undefined"
-    filename=filelist[filenum]
 
-    logWhere="File {}".format(filename)
-    logging.info("{}: Processing...".format(logWhere))
-    
-    file_data = {}
-    # Try to load as a JSON file.  Assume it is already in desired format.
-    try:
-        logging.debug("{}: Trying to load as json file...".format(logWhere))
-        with open(tabletFile,'r') as tablet_file:
-        # json.load returns a dictionary                                                                     
-            file_data = json.load(tablet_file)
-            tabletFileType = "json"
-    except:
-        logging.debug("{}: Error {}".format(logWhere,sys.exc_info()[:2]))
-        pass
+    logWhere=LogWhere(filename)
+    logging.info("%s: Processing...", logWhere)
 
-    if tabletFileType == "undefined":
-        # Try to load as a csv file.  Best to do last since open() will open other types.
+    fileFormat = sniffFormat(data)
+    logging.debug("%s: Looks like a %s file", logWhere,fileFormat)
+
+    file_data = {}
+    if fileFormat == "json":
+        # Load as a JSON file.  Assume it is already in desired format.
+        try:
+            file_data = json.loads(data)
+        except ValueError as e:
+            return None, "{}: Is not a valid json file - {}".format(logWhere,e)
+        if not isinstance(file_data, dict):
+            return None, "{}: Is not a valid json file - expected an object".format(logWhere)
+        tabletFileType = "json"
+
+    elif fileFormat == "csv":
+        # Load as a csv file.
         #
         # Assume:
         #   "," is the delimiter
         #   For format, see example *.csv
         #
-        
-        # Sheet keys
-        sheetKeysStr=["eType","grade","gender","field","group","comments","ratingTip"]
-        sheetKeysList=["teams","categories","ratingValues"]
-        
-        # Set initial values
-        validCsvData=True
-        sessionSelected={}
-        sheetSelected={}
-        playerDataColumn=-1
-        playerTeam="UNSET"
-        
+        parser = CsvBackupParser(filename, sheetFilter)
         try:
-            logging.debug("{}: Trying to load as csv file...".format(logWhere))
-            file_data = {"version": "", "sessions": []}
-            with open(tabletFile,'r') as tablet_file:
-                reader = csv.reader(tablet_file)
-
-                for rowIndex, row in enumerate(reader):
-                    logWhere="File {}: Row {}".format(filename,rowIndex+1)
-                    #logging.debug("{}: row={}".format(logWhere,row))
-
-                    # Don't try to handle non-ascii data.
-                    # App should prevent it but currently allows non-ascii in comments and ratingTip.
-                    if any(isNonAsciiCRLF(item) for item in row):
-                        logging.error("{}: Data files cannot contain non-ascii data".format(logWhere))
-                        validCsvData=False
-                        break
-                    
-                    # Strip each item in the row,
-                    # String trailing cells that have only whitespace
-                    # Skip empty rows
-                    row=[item.strip() for item in row]
-                    listRStrip(row)
-                    if not row:
-                        continue
+            logging.debug("%s: Trying to load as csv file...", logWhere)
+            validCsvData = parser.parse(data)
 
-                    # Find first non-empty cellIndex, cellValue.
-                    # One always exists due to skipping of empty rows above.
-                    cellIndex = next((indx for indx, val in enumerate(row) if val))
-                    cellValue = row[cellIndex]
+            # TODO: Update format of backup csv created by tablet app; have it include version
+            #       and update this script to look for it.
 
-                    # Skip lastRatingsChange
-                    if cellValue == "lastRatingsChange":
-                        continue
-                    
-                    # Used to determine if this row has player data column headings.
-                    rowHeadingIndex=getHeadingIndex(row)
-
-                    # Player data column headings in a role override any leading keywords (e.g., sessionName),
-                    # so we check for that first.
-                    if 0 < rowHeadingIndex:  # Row contains column headings for player data section
-                        if sheetSelected and sheetDefined(sheetSelected) and playerDataColumn < 0:  # Entering player data section
-                            # Record index of "team" heading.
-                            playerDataColumn=rowHeadingIndex
-                            
-                            # Check and set categories; remove last item if "lastRatingsChange"
-                            categories=row[playerDataColumn+2:]
-                            if categories[-1] == "lastRatingsChange":
-                                categories = categories[:-1]
-
-                            if not categories:
-                                logging.error("{}: Player data column headings are missing categories".format(logWhere))
-                                validCsvData=False
-                                break
-     
-                            if sheetSelected["categories"]:
-                                if sheetSelected["categories"] != categories:
-                                    logging.error("{}: Categories definitions do not match".format(logWhere))
-                                    logging.error(categories[-1])
-                                    validCsvData=False
-                                    break
-                            else:
-                                sheetSelected["categories"] = categories
-                            
-                            logging.debug("{}: Set playerData start index".format(logWhere))
-                            # TODO: Warn if ignoring cells before playerDataColumn aList[start:end]
-                            #ignoredCellsWarning(logWhere,row[:playerDataColumn])
-
-                        elif not sheetSelected or not sheetDefined(sheetSelected):
-                            logging.error("{}: SheetName must be defined (sheetname, eType, grade, gender) before player data section".format(logWhere))
-                            validCsvData=False
-                            break
-                            
-                        else: # 0 <= playerDataColumn ; already in player data section
-                            # Already in player data section
-                            logging.warning("{}: Ignoring player data heading inside player data section".format(logWhere))
-
-                    # Next we look for keywords
-                    elif cellValue == "version":
-                        if file_data["version"]:
-                            logging.warning("{}: Warning: version already set".format(logWhere))
-                        else:
-                            # Record app version.
-                            # Ignore remainder of row.
-                            file_data["version"]=listGet(row,cellIndex+1,0)
-                            logIfRemainder(row,cellIndex+2,"{}:".format(logWhere))
-
-                    elif cellValue == "sessionName":  # Entering defining-session section
-                        
-                        # Save current data and start a new session.
-                        if sheetSelected:
-                            sessionSelected["sheets"].append(sheetSelected);
-                            logging.debug("{}: Appended sheet {} to session {}".format(
-                                logWhere,sheetSelected["sheetName"],sessionSelected["sessionName"]))
-                            
-                        if sessionSelected:
-                            file_data["sessions"].append(sessionSelected);
-                            logging.debug("{}: Appended session {} to file_data".format(
-                                logWhere,sessionSelected["sessionName"]))
-                        sessionSelected={"sessionName":"" ,"sheets":[]}
-                        sheetSelected={}
-                        
-                        playerDataColumn=-1
-                        playerTeam="UNSET"
-                
-                        # Record session name.
-                        # Ignore remainder of row.
-                        sessionSelected["sessionName"]=listGet(row,cellIndex+1,"UNSET")
-                        logIfRemainder(row,cellIndex+2,"{}:".format(logWhere))
-
-                    elif cellValue == "sheetName": # Entering defining-sheet section
-                        # Create new session, if necessary.
-                        if not sessionSelected["sessionName"]:
-                            sessionSelected={"sessionName":"Default" ,"sheets":[]}
-                            logging.info("{}: Sheet not in a session; defined default session".format(logWhere))
-                    
-                        # Save current data and start a new sheet.
-                        if sheetSelected:
-                            sessionSelected["sheets"].append(sheetSelected);
-                            logging.debug("{}: Appended sheet {} to session {}".format(
-                                logWhere,sheetSelected["sheetName"],sessionSelected["sessionName"]))
-                        #sheetInit(sheetSelected)
-                        sheetSelected={"sheetName":"","eType":"","teams":[],"grade":"","gender":"",
-                           "field":"","group":"","comments":"","playerData":[],"categories":[],
-                           "ratingValues":[],"ratingTip":""}
-                        
-                        playerDataColumn=-1
-                        playerTeam="UNSET"
-
-                        # Record sheet name.
-                        # Ignore remainder of row.
-                        sheetSelected["sheetName"]=listGet(row,cellIndex+1,"UNSET")
-                        logIfRemainder(row,cellIndex+2,"{}:".format(logWhere))
-
-                    elif cellValue in sheetKeysStr + sheetKeysList:
-                        if sheetSelected and playerDataColumn < 0: # In defining-sheet section
-                            if cellValue in sheetKeysStr:
-                                # Record property.
-                                # Ignore remainder of row.
-                                sheetSelected[cellValue]=listGet(row,cellIndex+1,"")
-                                logIfRemainder(row,cellIndex+2,"{}:".format(logWhere))
-                                logging.debug("{}: Recorded {} in sheet {}".format(logWhere,cellValue,sheetSelected["sheetName"]))
-                            
-                            else: # cellValue in sheetKeysList:                            
-                                # Record property.
-                                # Ignore remainder of row.
-                                sheetSelected[cellValue]=listGet(row,cellIndex+1,"").split(',')
-                                logIfRemainder(row,cellIndex+2,"{}:".format(logWhere))
-                                logging.debug("{}: Recorded {} in sheet {}".format(logWhere,cellValue,sheetSelected["sheetName"]))
-
-                        elif not sheetSelected: 
-                            logging.error("{}: SheetName must be set before sheet keys".format(logWhere))
-                            validCsvData=False
-                            break
-
-                        else: # 0 <= playerDataColumn                           
-                            logging.error("{}: When starting a new sheet, sheetName must be set before sheet keys".format(logWhere))
-                            validCsvData=False
-                            break
-
-                    # Finally, we look for player data
-                    elif 0 <= playerDataColumn: # In player data section
-                        # Get team and id values
-                        teamVal=""
-                        idVal=""
-                        if -1 < playerDataColumn < len(row):
-                            teamVal=row[playerDataColumn]
-                        if -1 < playerDataColumn+1 < len(row):
-                            idVal=row[playerDataColumn+1]
-                           
-                        # If value in team column, set team.
-                        # Team initally ="UNSET" and can be inherited from previous row, but Id cannot.
-                        if teamVal or idVal:
-                            if teamVal:
-                                playerTeam=teamVal
-                            else:
-                                logging.info("{}: No team so using previous value".format(logWhere))
-                                
-                            if idVal:
-                                # isinstance( playerId, ( int, long ) )
-                                # try:
-                                #     value = int(value)
-                                # except ValueError:
-                                #     pass  # it was a string, not an int.
-                                playerId=idVal
-                                
-                                # Record ratings if non-empty TODO: should it record if empty?  What does app do?
-                                ratings={}
-                                for catIndex, cat in enumerate(sheetSelected["categories"]):
-                                    ratingIndex=playerDataColumn+2+catIndex
-                                    if ratingIndex < len(row) and row[ratingIndex]:
-                                        ratings[cat]=row[ratingIndex]
-                                sheetSelected["playerData"].append({"team":playerTeam,"id":playerId,"ratings":ratings})
-                                logging.debug("{}: Appended player data to sheet {}".format(logWhere,sheetSelected["sheetName"]))
-                            else:
-                                logging.info("{}: No id so only recording team".format(logWhere))
-                                
-                        else:
-                            logging.debug("{}: Neither team nor id values found in {}".format(logWhere,row))
+            if validCsvData:
+                tabletFileType = "csv"
 
-                    else:
-                        logging.warning("{}: No useful data found in {}".format(logWhere,row))
-            
-                # End of iteration over row
-                            
-                # TODO: Update format of backup csv created by tablet app; have it include version
-                #       and update this script to look for it.
-
-                if validCsvData:
-                    tabletFileType = "csv"
-
-                # Record last session and sheet worked on.
-                if sheetSelected:
-                    sessionSelected["sheets"].append(sheetSelected);
-                    logging.debug("{}: Appended sheet {} to session {}".format(
-                        logWhere,sheetSelected["sheetName"],sessionSelected["sessionName"]))
-                if sessionSelected:
-                    file_data["sessions"].append(sessionSelected);
-                    logging.debug("{}: Appended session {} to file_data".format(
-                        logWhere,sessionSelected["sessionName"]))
+            # Record last session and sheet worked on.
+            parser.finish()
+            file_data = parser.file_data
 
         except:
-            logging.debug("{}: Error {}".format(logWhere,sys.exc_info()[:2]))
+            logging.debug("%s: Error %s", parser.logWhere,sys.exc_info()[:2])
             pass
+        logWhere = parser.logWhere
             
     if tabletFileType == "undefined":
-        logComment="{}: Is not a valid json or csv file.".format(logWhere)
-        logging.error(logComment)
-        print "ERROR:",logComment
-    else:
-        file_data.update({'filename':tabletFile})
-        allData.append(file_data)
-
-# End of file processing
-
-## Process all the data
-logging.info("=== Processing all the data...")
-
-# Define a python dictionary object, which indexes data for printing by keys.
-compilation = {}
-sshList = []
-
-latestDBVersion = 0
-
-for item in allData:
-    filename=item['filename']
-    basename, file_extension = os.path.splitext(filename)
+        return None, "{}: Is not a valid json or csv file.".format(logWhere)
+
+    file_data.update({'filename':tabletFile})
+    logComment = quarantine(file_data)
+    if logComment:
+        return None, logComment
+    return file_data, None
+
+# Load each file with loadFile(), in filelist order.
+# Unchanged files are taken from the parse cache, if given; the rest are
+# parsed in a pool of jobs worker processes (0 = one per CPU) unless jobs is 1.
+# If fileTimes is given, the seconds taken to parse each file are recorded in it.
+# Files parsed with a sheetFilter are not added to the cache, since their csv
+# player data is incomplete.
+def loadFiles(filelist, jobs, logLevel, cache, fileTimes=None, sheetFilter=None, digests=None):
+    results = [None] * len(filelist)
+    stamps = {}
+    misses = []
+    for filenum, filename in enumerate(filelist):
+        if cache:
+            results[filenum], stamps[filenum] = cacheLookup(cache, filename, (digests or {}).get(filename))
+        if results[filenum] is None:
+            misses.append(filenum)
+        else:
+            logging.info("File %s: Loaded from cache", filename)
+
+    parsed = []
+    if jobs == 1:
+        parsed = [timedLoadFile((filelist[filenum], sheetFilter)) for filenum in misses]
+    elif misses:
+        # Parse files in a worker pool; map() returns results in filelist order.
+        pool = multiprocessing.Pool(jobs or None, initWorker, (logLevel,))
+        try:
+            parsed = pool.map(timedLoadFile, [(filelist[filenum], sheetFilter) for filenum in misses], 1)
+        finally:
+            pool.close()
+            pool.join()
+    for filenum, (result, seconds) in zip(misses, parsed):
+        results[filenum] = result
+        if fileTimes is not None:
+            fileTimes[filelist[filenum]] = seconds
+
+    if cache and sheetFilter is None:
+        for filenum in misses:
+            if stamps[filenum]:
+                cacheStore(cache, filelist[filenum], stamps[filenum], results[filenum])
+        cache.commit()
+    return results
+
+# Yield the file_data of each loadFile() result, reporting the files that
+# are not valid.
+def validFiles(results):
+    for file_data, logComment in results:
+        if file_data is None:
+            logging.error(logComment)
+            print "ERROR:",logComment
+        else:
+            yield file_data
+
+# Bytes read from the start of a file by scanVersion().
+VERSION_SCAN_BYTES = 4096
+
+# Read the db version from the start of a file without reading the rest: the
+# "version" member of a JSON file, or the first row of a csv file that
+# CsvBackupParser takes it from.
+# Returns the version as an int, or None if it is not found there (a version
+# after a large value, or a missing or invalid version); such files are
+# checked when they are compiled.
+def scanVersion(filename):
+    try:
+        if '/' in filename and splitArchiveMember(filename):
+            head = readData(filename)[:VERSION_SCAN_BYTES]
+        else:
+            with open(filename,'rb') as tablet_file:
+                head = tablet_file.read(VERSION_SCAN_BYTES)
+    except ARCHIVE_ERRORS:
+        return None
+    head = stripBom(head)
+    if sniffFormat(head) == "csv":
+        return scanCsvVersion(head)
+    stream = JsonStream(head)
+    try:
+        for key in stream.members():
+            value = stream.value()
+            if key == 'version':
+                return int(value) if value else None
+    except (ValueError, TypeError):
+        pass
+    return None
+
+# Return the version of scanVersion() from the head of a csv file.
+def scanCsvVersion(head):
+    # Leave out a last row that may be cut short.
+    rows = head.splitlines(True)
+    if len(head) == VERSION_SCAN_BYTES:
+        rows = rows[:-1]
+    try:
+        for row in csv.reader(rows):
+            row = [item.strip() for item in row]
+            cellIndex = next((indx for indx, val in enumerate(row) if val), None)
+            if cellIndex is not None and row[cellIndex] == 'version':
+                value = listGet(row, cellIndex+1, '')
+                return int(value) if value else None
+    except (csv.Error, ValueError):
+        pass
+    return None
+
+# Return the files of filelist to compile and the db version to compile:
+# the newest version found by scanVersion().  Files with an older version
+# are left out, so they are never parsed.
+def latestVersionFiles(filelist):
+    versions = dict((filename, scanVersion(filename)) for filename in filelist)
+    latestDBVersion = max([version for version in versions.values() if version is not None] or [0])
+    latestFiles = []
+    for filename in filelist:
+        if versions[filename] is not None and versions[filename] < latestDBVersion:
+            logging.warning('%s: Skipping since version %s is from an old db version.',
+                            LogWhere(filename),versions[filename])
+        else:
+            latestFiles.append(filename)
+    return latestFiles, latestDBVersion
+
+# Load a file like loadFile(), but stream JSON files (see streamJsonFile()).
+def streamFile(filename, sheetFilter=None):
+    data, logComment = readFile(filename)
+    if data is None:
+        return None, logComment
+    if sniffFormat(data) == "json":
+        return streamJsonFile(filename, data)
+    return parseData(filename, data, sheetFilter)
+
+# Load a JSON file without building all of its sessions at once.
+# Returns file_data like loadFile(), except that 'sessions', and the
+# 'sheets' of each session, are generators that decode one sheet at a time
+# as they are iterated, so only the sheet being compiled is held as python
+# objects.  A syntax error found while iterating is reported and ends the
+# file; the sheets before it have already been compiled.
+# Streaming needs 'version' before 'sessions' and 'sessionName' before
+# 'sheets', as the app writes them; other files are loaded whole.
+def streamJsonFile(filename, data):
+    logWhere=LogWhere(filename)
+    logging.info("%s: Streaming...", logWhere)
+
+    stream = JsonStream(data)
+    file_data = {}
+    try:
+        members = stream.members()
+        for key in members:
+            if key == 'sessions':
+                if 'version' not in file_data:
+                    break
+                file_data['quarantined'] = []
+                file_data['sessions'] = streamSessions(stream, members, logWhere, file_data['quarantined'])
+                file_data.update({'filename':filename})
+                problems = checkStreamedFile(file_data)
+                if problems:
+                    return None, "{}: Is not a valid data file - {}".format(logWhere,problemText(problems))
+                return file_data, None
+            file_data[key] = stream.value()
+        else:
+            if stream.peek():
+                raise ValueError("Extra data: char {}".format(stream.pos))
+            file_data.update({'filename':filename})
+            logComment = quarantine(file_data)
+            if logComment:
+                return None, logComment
+            return file_data, None
+    except ValueError as e:
+        return None, "{}: Is not a valid json file - {}".format(logWhere,e)
+
+    logging.debug("%s: Version does not precede sessions; loading whole file", logWhere)
+    return parseData(filename, data)
+
+# Yield the sessions of a streamed JSON file, then check the rest of it.
+# Sessions and sheets that do not match the schema are quarantined.
+def streamSessions(stream, members, logWhere, quarantined):
+    try:
+        for _ in stream.items():
+            session = {}
+            sessionMembers = stream.members()
+            for key in sessionMembers:
+                if key == 'sheets' and 'sessionName' in session:
+                    session['sheets'] = streamSheets(stream, sessionMembers, logWhere)
+                    break
+                session[key] = stream.value()
+            problems = checkStreamedSession(session)
+            if problems:
+                quarantined.append(quarantineMessage(logWhere.filename, session, None, problems))
+            else:
+                session['sheets'] = checkedSheets(session['sheets'], logWhere.filename, session, quarantined)
+                yield session
+            if isinstance(session.get('sheets'), types.GeneratorType):
+                # Skip any sheets the caller did not read.
+                for sheet in session['sheets']:
+                    pass
+            if stream.error:
+                return
+        for key in members:
+            stream.value()
+        if stream.peek():
+            raise ValueError("Extra data: char {}".format(stream.pos))
+    except ValueError as e:
+        stream.fail(logWhere, e)
+
+# Yield the sheets of a streamed session, then the rest of the session.
+def streamSheets(stream, sessionMembers, logWhere):
+    try:
+        for _ in stream.items():
+            yield stream.value()
+        for key in sessionMembers:
+            stream.value()
+    except ValueError as e:
+        stream.fail(logWhere, e)
+
+# Return (loadFile() result, seconds taken) for a (filename, sheetFilter) job.
+def timedLoadFile(job):
+    startTime = time.time()
+    result = loadFile(*job)
+    return result, time.time() - startTime
+
+# Configure logging in a worker process of the --jobs pool.
+# Forked workers inherit the handler; spawned ones append to the same log.
+def initWorker(logLevel):
+    logging.basicConfig(filename=LOGNAME, filemode='a', level=logLevel)
+
+# Open the parse cache, a sqlite file holding each file's loadFile() result
+# keyed by path, size, mtime and content hash.
+# Results cached by a different version of this script are discarded, as are
+# all results if clear is set.
+def openCache(cachename, clear):
+    with open(__file__,'rb') as script_file:
+        scriptHash = hashlib.sha1(script_file.read()).hexdigest()
+    cache = sqlite3.connect(cachename)
+    cache.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    cache.execute('CREATE TABLE IF NOT EXISTS files '
+                  '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, result TEXT)')
+    row = cache.execute("SELECT value FROM meta WHERE key='script'").fetchone()
+    if clear or not row or row[0] != scriptHash:
+        logging.info('Clearing cache %s', cachename)
+        cache.execute('DELETE FROM files')
+        cache.execute("INSERT OR REPLACE INTO meta VALUES ('script',?)", (scriptHash,))
+        cache.commit()
+    return cache
+
+# Look up a file in the parse cache.
+# Returns (result, stamp); result is None on a miss, and stamp is the
+# (size, mtime, hash) to store the parsed result under, or None if the file
+# cannot be read.
+# A file whose size or mtime changed is still a hit if its contents did not.
+# digest is the sha1 of the file if it is already known.
+def cacheLookup(cache, filename, digest=None):
+    path = os.path.abspath(filename)
+    try:
+        st = os.stat(filename)
+        row = cache.execute('SELECT size, mtime, hash, result FROM files WHERE path=?', (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return tuple(json.loads(row[3])), None
+        if digest is None:
+            with open(filename,'rb') as tablet_file:
+                digest = hashlib.sha1(tablet_file.read()).hexdigest()
+    except (IOError, OSError):
+        return None, None
+    stamp = (st.st_size, st.st_mtime, digest)
+    if row and row[2] == digest:
+        cacheStore(cache, filename, stamp, json.loads(row[3]))
+        return tuple(json.loads(row[3])), None
+    return None, stamp
+
+# Return the sha1 the parse cache recorded for a file if its size and mtime
+# did not change since, or None.
+def cachedHash(cache, filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    row = cache.execute('SELECT size, mtime, hash FROM files WHERE path=?',
+                        (os.path.abspath(filename),)).fetchone()
+    if row and row[0] == st.st_size and row[1] == st.st_mtime:
+        return row[2]
+    return None
+
+# Record a loadFile() result in the parse cache.
+def cacheStore(cache, filename, stamp, result):
+    cache.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)',
+                  (os.path.abspath(filename),) + stamp + (json.dumps(result),))
+
+# Sentinel for a missing value in the KeyStore arrays.
+NO_VALUE = -2**31
+
+# Compiled data for one grade/gender/eType key.
+# Station and category names are interned as indexes, and each player is a
+# dense row of (ratings..., total) per station in an array, so a player costs
+# a few bytes per rating instead of nested dicts per station.
+# A rating that is not an int ('' or an invalid rating that is reported as
+# is) is NO_VALUE in the array, with any value other than '' kept in other.
+# A station total of NO_VALUE means the player has no scores for it.
+class KeyStore(object):
+    def __init__(self):
+        self.stationList = []
+        self.stationIndex = {}  # station -> position in stationList
+        self.nextSuffix = {}    # station -> first suffix that may be free
+        self.categories = []
+        self.kComments = []
+        self.data = {}       # team -> id -> row number
+        self.rows = []
+        self.pComments = {}  # row number -> comments
+        self.other = {}      # (row number, cell) -> value
+
+    def addStation(self, station):
+        self.stationIndex[station] = len(self.stationList)
+        self.stationList.append(station)
+
+    def isStation(self, station):
+        return station in self.stationIndex
+
+    # Return the first name station-N (N = 1, 2, ...) that is not a station yet.
+    # Stations are never removed, so the search resumes where the last one ended.
+    def freeStationName(self, station):
+        count = self.nextSuffix.get(station, 1)
+        while station + '-' + str(count) in self.stationIndex:
+            count += 1
+        self.nextSuffix[station] = count
+        return station + '-' + str(count)
+
+    # Rename a station to a free name and record a program comment.
+    def renameStation(self, logWhere, station):
+        newStationName = self.freeStationName(station)
+        newProgComment = "{}: Renamed {} to {}".format(logWhere, station, newStationName)
+        logging.info(newProgComment)
+        self.kComments.append("Program: " + newProgComment)
+        return newStationName
+
+    def setCategories(self, categories):
+        if len(categories) != len(self.categories) and self.rows:
+            # Lay out the rows again for the new number of categories.
+            scores = [(rowNum, station, self.scores(rowNum, station))
+                      for rowNum in range(len(self.rows)) for station in self.stationList]
+            self.rows = [array.array('l') for row in self.rows]
+            self.other = {}
+            self.categories = categories
+            for rowNum, station, score in scores:
+                if score:
+                    ratings, total = score
+                    ratings = (ratings + [''] * len(categories))[:len(categories)]
+                    self.setScores(rowNum, station, ratings, total)
+        self.categories = categories
+
+    # Return the row number of a player, or None.
+    def row(self, teamKey, idNum):
+        return self.data.get(teamKey, {}).get(idNum)
+
+    def addPlayer(self, teamKey, idNum):
+        self.data.setdefault(teamKey, {})[idNum] = len(self.rows)
+        self.rows.append(array.array('l'))
+        return len(self.rows) - 1
+
+    # Drop a player that has no scores or comments left.  The row is not reused.
+    def removePlayer(self, teamKey, idNum):
+        rowNum = self.data[teamKey][idNum]
+        if rowNum in self.pComments or any(self.hasStation(rowNum, station) for station in self.stationList):
+            return
+        del self.data[teamKey][idNum]
+        if not self.data[teamKey]:
+            del self.data[teamKey]
+
+    # Iterate over (team, id, row number), sorted by team then id.
+    def players(self):
+        for teamKey in sorted(self.data):
+            for idNum in sorted(self.data[teamKey], key=int):
+                yield teamKey, idNum, self.data[teamKey][idNum]
+
+    def _block(self, station):
+        return self.stationIndex[station] * (len(self.categories) + 1)
+
+    def _get(self, rowNum, cell):
+        row = self.rows[rowNum]
+        if cell < len(row) and row[cell] != NO_VALUE:
+            return row[cell]
+        return self.other.get((rowNum, cell), '')
+
+    def _set(self, rowNum, cell, value):
+        row = self.rows[rowNum]
+        if len(row) <= cell:
+            row.extend(array.array('l', [NO_VALUE]) * (cell + 1 - len(row)))
+        self.other.pop((rowNum, cell), None)
+        row[cell] = NO_VALUE
+        if type(value) is int and value != NO_VALUE:
+            try:
+                row[cell] = value
+                return
+            except OverflowError:
+                pass
+        if value != '':
+            self.other[(rowNum, cell)] = value
+
+    # Check if a player has scores for a station.
+    def hasStation(self, rowNum, station):
+        if station not in self.stationIndex:
+            return False
+        cell = self._block(station) + len(self.categories)
+        row = self.rows[rowNum]
+        return (cell < len(row) and row[cell] != NO_VALUE) or (rowNum, cell) in self.other
+
+    # Record a player's ratings (in categories order) and total for a station
+    # the player has no scores for yet.
+    def setScores(self, rowNum, station, ratings, total):
+        block = self._block(station)
+        values = list(ratings) + [total]
+        row = self.rows[rowNum]
+        if len(row) < block + len(values):
+            row.extend(array.array('l', [NO_VALUE]) * (block + len(values) - len(row)))
+        if NO_VALUE not in values and all(type(value) is int for value in values):
+            try:
+                row[block:block + len(values)] = array.array('l', values)
+                return
+            except OverflowError:
+                pass
+        for cell, value in enumerate(values, block):
+            self._set(rowNum, cell, value)
+
+    # Remove a player's ratings and total for a station.
+    def clearScores(self, rowNum, station):
+        block = self._block(station)
+        for cell in range(block, block + len(self.categories) + 1):
+            self._set(rowNum, cell, '')
+
+    # Return (ratings, total) of a player for a station, or None.
+    def scores(self, rowNum, station):
+        if not self.hasStation(rowNum, station):
+            return None
+        block = self._block(station)
+        return ([self._get(rowNum, block + catIndex) for catIndex in range(len(self.categories))],
+                self._get(rowNum, block + len(self.categories)))
+
+    def addComment(self, rowNum, comment):
+        self.pComments[rowNum] = self.pComments.get(rowNum, '') + comment
+
+    def comment(self, rowNum):
+        return self.pComments.get(rowNum, '')
+
+    # Remove a comment added with addComment().
+    def removeComment(self, rowNum, comment):
+        text = self.pComments.get(rowNum, '')
+        index = text.find(comment)
+        if index != -1:
+            text = text[:index] + text[index + len(comment):]
+            if text:
+                self.pComments[rowNum] = text
+            else:
+                del self.pComments[rowNum]
+
+    # Check if any player has scores for a station; after a retraction one may not.
+    def stationUsed(self, station):
+        return any(self.hasStation(rowNum, station) for ids in self.data.values() for rowNum in ids.values())
+
+# Round half away from zero, as python 2 round() does.
+def roundHalfAway(x):
+    y = math.floor(abs(x))
+    if 0.5 <= abs(x) - y:
+        y += 1
+    return int(math.copysign(y, x))
+
+# Kinds of rating problems reported by scoreSheet().
+INVALID_RATING = 'invalid'
+ROUNDED_RATING = 'rounded'
+
+# Validated ratings by (type, raw rating); a season has only a handful of
+# distinct raw ratings, so each is checked and rounded once.
+_checkedRatings = {}
+
+# Validate a raw rating.
+# Returns (rating, counted, value, problem): rating is the int to record, or
+# the raw rating if it is empty or invalid; counted is 1 and value is the
+# rating if it is a valid rating, else both are 0.
+def checkRating(origRating):
+    try:
+        return _checkedRatings[(type(origRating), origRating)]
+    except KeyError:
+        pass
+    except TypeError:  # Unhashable; check it every time.
+        return _checkRating(origRating)
+    checked = _checkedRatings[(type(origRating), origRating)] = _checkRating(origRating)
+    return checked
+
+def _checkRating(origRating):
+    if origRating == '':
+        return '', 0, 0, None
+    if not (type(origRating) is float or str(origRating).isdigit()):
+        return origRating, 0, 0, INVALID_RATING
+    # Make sure it's an int and flag any rounding.
+    # xlrd reads numbers as floats and json reads them as strings.
+    rating = roundHalfAway(float(origRating))
+    if float(origRating) != rating:
+        return rating, 1, rating, ROUNDED_RATING
+    return rating, 1, rating, None
+
+# Score all players of a sheet at once, one category column at a time.
+# Returns, for each entry of playerData, (ratings, total, ratingsCount,
+# problems) where ratings are in categories order and problems lists the
+# (category, problem, origRating, rating) of invalid and rounded ratings.
+# When ratings are missing, the total is scaled up from the average of the
+# valid ones.
+def scoreSheet(playerData, categories):
+    if not categories:
+        return [([], 0, 0, [])] * len(playerData)
+
+    ratingsCols, countCols, valueCols = [], [], []
+    problems = {}
+    for c in categories:
+        ratingsCol, countCol, valueCol, problemCol = zip(*[checkRating(p['ratings'].get(c, '')) for p in playerData])
+        ratingsCols.append(ratingsCol)
+        countCols.append(countCol)
+        valueCols.append(valueCol)
+        if any(problemCol):
+            for playerIndex, problem in enumerate(problemCol):
+                if problem:
+                    problems.setdefault(playerIndex, []).append(
+                        (c, problem, playerData[playerIndex]['ratings'][c], ratingsCol[playerIndex]))
+
+    ratingsRows = list(zip(*ratingsCols))
+    counts = list(map(sum, zip(*countCols)))
+    totals = list(map(sum, zip(*valueCols)))
+    sheetScores = []
+    for playerIndex in range(len(playerData)):
+        ratingsCount = counts[playerIndex]
+        total = totals[playerIndex]
+        if 0 < ratingsCount < len(categories):
+            total = roundHalfAway(len(categories) * total/float(ratingsCount))
+        sheetScores.append((list(ratingsRows[playerIndex]), total, ratingsCount, problems.get(playerIndex, [])))
+    return sheetScores
+
+# Return the csv table of one key of the report.
+def keyReport(key, store):
+    outFile = cStringIO.StringIO()
+    writer = csv.writer(outFile, lineterminator='\n')
+    categories = store.categories
+    stations = sorted(station for station in store.stationList if store.stationUsed(station))
+    hasTotal = 1 < len(categories)
+    writer.writerow([key])
+
+    # First heading row: station for each category and total
+    row = ['id']
+    for station in stations:
+        row += [station] * (len(categories) + hasTotal)
+    row.append('Comments (see ' + LOGNAME + ' for details)')
+    writer.writerow(row)
+
+    # Second heading row: categories and total
+    row = ['']
+    for station in stations:
+        row += categories
+        if hasTotal:
+            row.append('Total')
+    row.append('')
+    writer.writerow(row)
+
+    for teamKey, idNum, rowNum in store.players():
+        row = [playerLabel(teamKey, idNum)]
+        for station in stations:
+            scores = store.scores(rowNum, station)
+            if scores:
+                row += scores[0]
+                if hasTotal:
+                    row.append(scores[1])
+            else:
+                row += [''] * (len(categories) + hasTotal)
+        row.append(store.comment(rowNum))
+        writer.writerow(row)
+
+    # Comments, if any
+    if store.kComments:
+        writer.writerow(['Comments:'])
+        for c in store.kComments:
+            writer.writerow(['  ' + c])
+    writer.writerow([])
+    return outFile.getvalue()
+
+# Return the id column of a player in the reports, e.g. g38.
+def playerLabel(teamKey, idNum):
+    # Use only 1 char of team and make lowercase
+    return str(teamKey.lower()[:1]) + str(idNum)
+
+# Category name of a station total in Rankings.
+TOTAL = 'Total'
+
+# Rankings of the players of one key.  Each column, a category or the
+# total of a station, or with station None the sum of a player's station
+# totals, is indexed once as a sorted list of its values, so rank() and
+# percentile() are bisections; top() selects with a heap.
+# Players are (team, id), and invalid ratings are left out.
+class Rankings(object):
+    def __init__(self, store):
+        self.stations = sorted(station for station in store.stationList if store.stationUsed(station))
+        self.columns = {(None, TOTAL): {}}  # (station, category) -> {player: value}
+        self.stationCounts = {}             # player -> number of stations scored
+        overall = self.columns[(None, TOTAL)]
+        players = list(store.players())
+        for station in self.stations:
+            ratingColumns = [self.columns.setdefault((station, category), {}) for category in store.categories]
+            totals = self.columns.setdefault((station, TOTAL), {})
+            for teamKey, idNum, rowNum in players:
+                scores = store.scores(rowNum, station)
+                if not scores:
+                    continue
+                player = (teamKey, idNum)
+                ratings, total = scores
+                for column, rating in zip(ratingColumns, ratings):
+                    if type(rating) is int:
+                        column[player] = rating
+                totals[player] = total
+                overall[player] = overall.get(player, 0) + total
+                self.stationCounts[player] = self.stationCounts.get(player, 0) + 1
+        self.index = dict((column, sorted(values.itervalues())) for column, values in self.columns.items())
+
+    # Return a player's value in a column, or None.
+    def value(self, player, station=None, category=TOTAL):
+        return self.columns.get((station, category), {}).get(player)
+
+    # Return the players with the n highest values of a column as
+    # [(player, value)], highest first; ties are in team and id order.
+    def top(self, n, station=None, category=TOTAL):
+        values = self.columns.get((station, category), {})
+        return heapq.nsmallest(n, values.iteritems(), key=lambda item: (-item[1], item[0][0], int(item[0][1])))
+
+    # Return a player's rank in a column (1 is the highest value; ties share
+    # a rank), or None if the player has no value in it.
+    def rank(self, player, station=None, category=TOTAL):
+        value = self.value(player, station, category)
+        if value is None:
+            return None
+        values = self.index[(station, category)]
+        return len(values) - bisect.bisect_right(values, value) + 1
+
+    # Return the percentage of a column's values below a player's value,
+    # counting ties as half below, or None if the player has no value in it.
+    def percentile(self, player, station=None, category=TOTAL):
+        value = self.value(player, station, category)
+        if value is None:
+            return None
+        values = self.index[(station, category)]
+        below = bisect.bisect_left(values, value)
+        ties = bisect.bisect_right(values, value) - below
+        return 100.0 * (below + ties / 2.0) / len(values)
+
+# Return the csv table of one key of the --rank report: players by the sum
+# of their station totals, with the total and percentile of each station.
+# Only the top players are listed if top is given.
+def rankReport(key, rankings, top=None):
+    outFile = cStringIO.StringIO()
+    writer = csv.writer(outFile, lineterminator='\n')
+    writer.writerow([key])
+
+    row = ['rank', 'id', 'Stations', TOTAL, 'Percentile']
+    for station in rankings.stations:
+        row += [station, station]
+    writer.writerow(row)
+    writer.writerow([''] * 5 + [TOTAL, 'Percentile'] * len(rankings.stations))
+
+    players = rankings.top(top if top else len(rankings.columns[(None, TOTAL)]))
+    for player, total in players:
+        row = [rankings.rank(player), playerLabel(*player), rankings.stationCounts[player], total,
+               '{:.1f}'.format(rankings.percentile(player))]
+        for station in rankings.stations:
+            stationTotal = rankings.value(player, station)
+            if stationTotal is None:
+                row += ['', '']
+            else:
+                row += [stationTotal, '{:.1f}'.format(rankings.percentile(player, station))]
+        writer.writerow(row)
+    writer.writerow([])
+    return outFile.getvalue()
+
+# What one sheet of a file contributed to an incremental compilation, as
+# undo records for Compiler.retract():
+#   ('fingerprint', fingerprint)       the sheet is in sshIndex
+#   ('waiting', fingerprint)           skipped as a duplicate of that sheet
+#   ('station', key, station, base)    its scores go in station, renamed from base if different
+#   ('kComment', key, comment)
+#   ('scores', key, team, id, station)
+#   ('pComment', key, team, id, comment)
+class SheetLedger(object):
+    def __init__(self, filename, file_extension, sName, sh):
+        self.filename = filename
+        self.file_extension = file_extension
+        self.sName = sName
+        self.sh = sh
+        self.entries = []
+
+# Return the id of a sheet within its file: session and sheet name, and how
+# many sheets with those names came before it (seen counts them).
+def sheetId(seen, sName, sh):
+    names = (sName, sh['sheetName'])
+    seen[names] = seen.get(names, -1) + 1
+    return names + (seen[names],)
+
+# Check if a sheet differs from its earlier version old.  The app moves
+# lastRatingsChange (to the minute) only when a rating changes, so comments
+# and players are compared too, and a sheet stamped no earlier than newest,
+# the latest stamp of the earlier version, may have changed again in that
+# same minute, so it is compared in full.
+def sheetChanged(old, sh, newest):
+    stamp = sh.get('lastRatingsChange') or ''
+    if stamp != (old.get('lastRatingsChange') or '') or sh['comments'] != old['comments']:
+        return True
+    if [(p['team'], p['id']) for p in sh['playerData']] != [(p['team'], p['id']) for p in old['playerData']]:
+        return True
+    return (not stamp or newest <= stamp) and sh != old
 
-    logWhere="File {}".format(filename)
-    logging.info("{}: Processing...".format(logWhere))
+# Compile the file_data of loadFile() into a KeyStore per key.
+# Files can be added at any time, so a long-running process can keep a
+# Compiler and add new files to it; render() writes the report of
+# everything added so far.
+#
+# For key '6thGirlsNight1':
+#   kComments:   ['File soccer.1.68.txt: Session 0522_6-8pm: Sheet 6thGirlsNight1Station5Group3: Has comment - Thanks so']
+#   categories:  ['A','B']
+#   stationList: ['Station5']
+#   data:        {'White': {'38': 0}, 'Green': {'34': 1}}   (team -> id -> row)
+#   rows:        [array('l', [NO_VALUE, NO_VALUE, 0]),       (Station5: A, B, total)
+#                 array('l', [4, 4, 8])]
+#   pComments:   {0: 'In station Station5 but with no ratings. '}
+#
+# When processed, team values ("Green", "White", "Red", or "Blue")
+#   will be changed to "g", w", "r", "b".                                      
+#
+# An incremental Compiler keeps a SheetLedger of every sheet, so that adding
+# a file again only recompiles the sheets that changed since (see
+# sheetChanged()), after retracting what their earlier version added, and
+# remove() retracts a whole file.  Retracted sheets leave their stations'
+# names taken, and recompiled sheets' comments come last.  Scores that went
+# into "additional scores" comments cannot be put back in place, and sheets
+# renamed away from a station cannot be moved back when retraction empties
+# it; in both cases needsRebuild is set and the caller should compile all
+# files again.
+class Compiler(object):
+    # Files with a db version older than latestDBVersion are skipped, and so
+    # are the sheets that sheetFilter, if given, does not match.
+    def __init__(self, latestDBVersion=0, sheetFilter=None, incremental=False):
+        # Define a python dictionary object, which indexes data for printing by keys.
+        self.compilation = {}
+        # Index of session:sheet fingerprints to the file that first supplied them.
+        self.sshIndex = {}
+        self.latestDBVersion = latestDBVersion
+        self.sheetFilter = sheetFilter
+        # Counters for --metrics-json.
+        self.counts = {'files': 0, 'sheets': 0, 'playerRows': 0, 'duplicateSheets': 0,
+                       'stationsRenamed': 0, 'players': 0, 'ratingsAveraged': 0, 'filteredSheets': 0,
+                       'quarantined': 0}
+        self.incremental = incremental
+        self.resetLedgers()
+        # Rendered keyReport() and Rankings of each key, and the keys changed since.
+        self.rendered = {}
+        self.rankings = {}
+        self.changed = set()
+
+    def resetLedgers(self):
+        self.merged = {}        # filename -> {sheet id: SheetLedger}
+        self.waiting = {}       # fingerprint -> ledgers of the duplicates skipped for it
+        self.conflicts = set()  # (key, station) with "additional scores" comments
+        self.renamed = {}       # (key, station) -> number of sheets renamed away from station
+        self.needsRebuild = False
+
+    # Add the file_data of a valid file to the compilation.
+    # In an incremental compilation, adding a file again replaces it.
+    def add(self, item):
+        previous = {}
+        if self.incremental:
+            previous = self.merged.pop(item['filename'], {})
+        self.fileLedgers = {}
+        self.addFile(item, previous)
+        # Left over if the file is skipped now.
+        for ledger in previous.values():
+            self.retract(ledger)
+        if self.incremental:
+            self.merged[item['filename']] = self.fileLedgers
+
+    # Retract everything a file added to an incremental compilation.
+    def remove(self, filename):
+        for ledger in self.merged.pop(filename, {}).values():
+            self.retract(ledger)
+
+    def addFile(self, item, previous):
+        self.counts['files'] += 1
+        filename=item['filename']
+        basename, file_extension = os.path.splitext(filename)
+
+        logWhere=LogWhere(filename)
+        logging.info("%s: Processing...", logWhere)
     
-    #print json.dumps(item, sort_keys=True)
-
-    # TODO: Should we verify that expected keys exist?
-    if 'version' in item and item['version']:
-        try:
-            dbVersion=int(item['version'])
-        except:
-            logging.error('{}: Skipping since db version {} is invalid.'.format(logWhere,item['version']))
-            continue
+        #print json.dumps(item, sort_keys=True)
+
+        # Expected keys were checked by quarantine() when the file was loaded.
+        if 'version' in item and item['version']:
+            try:
+                dbVersion=int(item['version'])
+            except:
+                logging.error('%s: Skipping since db version %s is invalid.', logWhere,item['version'])
+                return
+            else:
+                if dbVersion < self.latestDBVersion:
+                    logging.warning('%s: Skipping since version %s is from an old db version.', logWhere,dbVersion)
+                    return
+                elif self.latestDBVersion < dbVersion:
+                    if self.latestDBVersion:
+                        logging.warning('%s: Has a more recent db version.  Discarding previous, older data.', logWhere)
+                        self.compilation = {}
+                        self.sshIndex={}
+                        self.rendered = {}
+                        self.rankings = {}
+                        self.resetLedgers()
+                        previous.clear()
+                    self.latestDBVersion=dbVersion
+        elif file_extension != ".csv":
+            logging.error('%s: Skipping since db version is missing.', logWhere)
+            return
         else:
-            if dbVersion < latestDBVersion:
-                 logging.warning('{}: Skipping since version {} is from an old db version.'.format(logWhere))
-            elif 0 < latestDBVersion < dbVersion:
-                logging.warning('{}: Has a more recent db version.  Discarding previous, older data.'.format(logWhere))
-                compilation = {}
-                sshList=[]
-                latestDBVersion=dbVersion
-    elif file_extension != ".csv":
-        logging.error('{}: Skipping since db version is missing.'.format(logWhere))
-        continue
-    else:
-        logging.warning('{}: Version key is missing, but processing anyway.'.format(logWhere))
+            logging.warning('%s: Version key is missing, but processing anyway.', logWhere)
     
-    if 'sessions' not in item:
-        logging.error('{}: Has no "sessions" key'.format(logWhere))
-        continue
-    for s in item['sessions']:
-        sName=s['sessionName']
+        if 'sessions' not in item:
+            logging.error('%s: Has no "sessions" key', logWhere)
+            return
+        sessions = item['sessions']
+        if previous:
+            sessions = self.retractChanged(sessions, previous)
+        seen = {}
+        for s in sessions:
+            sName=s['sessionName']
         
-        logWhere="File {}: Session {}".format(filename,sName)
-        logging.info("{}: Processing...".format(logWhere))
-
-        if 'sheets' not in s:
-            logging.error('{}: has no "sheets" key'.format(logWhere))
-            continue
-        for sh in s['sheets']:
-            shName=sh['sheetName']
-
-            logWhere="File {}: Session {}: Sheet {}".format(filename,sName,shName)
-            logging.info("{}: Processing...".format(logWhere))
+            logWhere=LogWhere(filename,session=sName)
+            logging.info("%s: Processing...", logWhere)
 
-            # Check for duplicate session:sheet
-            itemNew=(sName,shName,sh)
-            if itemNew in sshList:
-                logging.warning('{}: Skipping because it is a duplicate.'.format(logWhere))
+            if 'sheets' not in s:
+                logging.error('%s: has no "sheets" key', logWhere)
                 continue
-            else:
-                # Insert, in sort order, new sheet into sheet list.
-                position=bisect.bisect(sshList,itemNew)
-                bisect.insort(sshList,itemNew)
-
-            # Proceed
-            key=sh['grade']+sh['gender']+sh['eType']
-            station=sh['field']
-            group=sh['group']
-            categories=sh['categories']
-            ratingsValues=sh['ratingValues']
-
-            # Check if sheet is empty
-            if not sh['playerData']:
-                logging.warning('{}: Skipping since it contains no players'.format(logWhere))
-                continue
-            
-            # TODO - Update db in app and remove this kludge
-            # Check for old ratingsValues (indicates old data)
-            if file_extension != ".csv":
-                isOld=0
-                if (sh['eType']=='Night1' or sh['eType']=='Night2') and (len(sh['ratingValues']) != 6):
-                    isOld=1
-                elif (sh['eType']=='Bubble') and (len(sh['ratingValues']) != 20):
-                    isOld=1
-                if isOld:
-                    # Should never get here unless db version incorrectly recorded in app
-                    # or csv file is using wrong ratingValues.
-                    # Any changes to pre-defined ratings should result in a new db version.
-                    logging.warning('{}: Skipping since ratingsValues are old'.format(logWhere))
+            for sh in s['sheets']:
+                if not self.incremental:
+                    self.addSheet(filename,file_extension,sName,sh)
                     continue
-
-            # Check for old session
-            if sName[:4].isdigit():
-                sNum=int(sName[1:4])
-                if (sNum < 519):
-                    logging.warning('{}: Possibly an old session; consider removing it,'.format(logWhere))
-            
-            # Record key
-            if (key not in compilation):
-                logging.debug('{}: Adding compilation[{}]'.format(logWhere,key))
-                compilation[key]={'stationList':[],'categories':[],'kComments':[],'data':{}}
-
-            # Check for sheetname having custom post-fix
-            shPostFix=shName.replace(key+station+group,"",1)
-            
-            # Handle unset station/field
-            if station=='':  # Should only happen with eType='Bubble' or 'Custom'
-                station="Field"
-                
-            if shPostFix:
-                # Record program comment.         
-                logging.warning("{}: Adding custom post-fix {} to {}".format(logWhere,shPostFix,station))
-                station+=shPostFix
-                
-            # If Bubble field, try to make it unique.
-            if sh['eType']=='Bubble':
-                if station in compilation.get(key,{}).get('stationList',[]):
-                    # Rename station
-                    nameFound=0
-                    count=1
-                    while (not nameFound) & (count < 10):
-                        newStationName=station + '-' + str(count)
-                        if (newStationName not in compilation[key]['stationList']):
-                            nameFound=1
-                            
-                            # Record program comment.  Here since it's not necessary if new name comes from sheet name.
-                            newProgComment="{}: Renamed {} to {}".format(logWhere,station,newStationName)
-                            logging.info(newProgComment)
-                            compilation[key]['kComments'].append("Program: "+newProgComment)
-                            station=newStationName
-                            
-                            break
-                        else:
-                            count+=1
-                    if not nameFound:
-                        newProgComment="{}: Could not create unique name for duplicate station/field {}".format(logWhere,station)
-                        logging.error(newProgComment)
-                        compilation[key]['kComments'].append("Program: "+newProgComment)
-                
-            # Record sheet comment
-            # First deal with non-ascii in comments.  Also remove \n and \r
-            shComment_ascii=removeNonAsciiCRLF(sh['comments'])
-            if shComment_ascii:
-                newShComment="{}: Has comment - {}".format(logWhere,shComment_ascii)
-                logging.info(newShComment)
-                compilation[key]['kComments'].append(newShComment)
-            
-            # Record categories and make sure they match
-            if (len(compilation[key]['categories'])) and (compilation[key]['categories'] != categories):
-                # Should never get here unless db version incorrectly recorded in app.
-                # Any changes to pre-defined categories or ratings should result in a new db version.
-                logging.error('{}: Categories mismatch - {} != {}'.format(logWhere,compilation[key]['categories'],categories))
-                continue
+                sId = sheetId(seen, sName, sh)
+                if sId in previous:
+                    # Unchanged since the file was last added.
+                    ledger = self.fileLedgers[sId] = previous.pop(sId)
+                    ledger.sh = sh
+                else:
+                    ledger = self.fileLedgers[sId] = SheetLedger(filename, file_extension, sName, sh)
+                    self.addSheet(filename,file_extension,sName,sh,ledger)
+
+        # Report the sessions and sheets left out when the file was loaded;
+        # a streamed file has found them all only now.
+        for message in item.get('quarantined', ()):
+            logging.error(message)
+            print "ERROR:",message
+            self.counts['quarantined'] += 1
+
+    # Retract the sheets of the earlier version of a file (previous) that
+    # changed or are gone, leaving the unchanged ones in previous.
+    # Returns the sessions, with streamed sheets read into lists.
+    def retractChanged(self, sessions, previous):
+        sessions = [dict(s, sheets=list(s['sheets'])) if 'sheets' in s else s for s in sessions]
+        newest = max(ledger.sh.get('lastRatingsChange') or '' for ledger in previous.values())
+        current = {}
+        seen = {}
+        for s in sessions:
+            for sh in s.get('sheets', []):
+                current[sheetId(seen, s['sessionName'], sh)] = sh
+        for sId, ledger in previous.items():
+            if sId not in current or sheetChanged(ledger.sh, current[sId], newest):
+                logging.info('%s: Changed since the file was last added',
+                             LogWhere(ledger.filename, session=ledger.sName, sheet=ledger.sh['sheetName']))
+                del previous[sId]
+                self.retract(ledger)
+        return sessions
+
+    # Undo what a sheet added to the compilation.  If another file's copy of
+    # it was skipped as a duplicate, that copy is compiled in its place.
+    def retract(self, ledger):
+        compilation = self.compilation
+        promote = None
+        for entry in reversed(ledger.entries):
+            kind = entry[0]
+            if kind == 'fingerprint':
+                del self.sshIndex[entry[1]]
+                if self.waiting.get(entry[1]):
+                    promote = self.waiting[entry[1]].pop(0)
+            elif kind == 'waiting':
+                self.waiting[entry[1]].remove(ledger)
+            elif kind == 'kComment':
+                compilation[entry[1]].kComments.remove(entry[2])
+                self.changed.add(entry[1])
+            elif kind == 'station':
+                key, station, base = entry[1:]
+                if station != base:
+                    self.renamed[(key, base)] -= 1
+                if self.renamed.get((key, station)) and not compilation[key].stationUsed(station):
+                    self.needsRebuild = True
             else:
-                logging.debug('{}: Recording categories {} in compilation'.format(logWhere,categories))
-                compilation[key]['categories']=categories
+                store = compilation[entry[1]]
+                self.changed.add(entry[1])
+                rowNum = store.row(entry[2], entry[3])
+                if kind == 'scores':
+                    if (entry[1], entry[4]) in self.conflicts:
+                        self.needsRebuild = True
+                    store.clearScores(rowNum, entry[4])
+                else:
+                    store.removeComment(rowNum, entry[4])
+                store.removePlayer(entry[2], entry[3])
+        for key in set(entry[1] for entry in ledger.entries if entry[0] not in ('fingerprint', 'waiting')):
+            if not compilation[key].data and not compilation[key].kComments:
+                del compilation[key]
+        ledger.entries = []
+        if promote:
+            promote.entries = []
+            self.addSheet(promote.filename, promote.file_extension, promote.sName, promote.sh, promote)
+
+    # Add a session:sheet of a file to the compilation, recording what it
+    # added in ledger, if given.
+    def addSheet(self, filename, file_extension, sName, sh, ledger=None):
+        compilation=self.compilation
+        undo = ledger.entries.append if ledger else lambda entry: None
+
+        # Level guards for the per-player and per-rating messages.
+        logInfo = logging.getLogger().isEnabledFor(logging.INFO)
+        logDebug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        shName=sh['sheetName']
+        self.counts['sheets'] += 1
+        self.counts['playerRows'] += len(sh['playerData'])
+
+        logWhere=LogWhere(filename,session=sName,sheet=shName)
+        logging.info("%s: Processing...", logWhere)
+
+        # Drop sheets outside the filter before any other work.
+        if self.sheetFilter and not self.sheetFilter.matches(sh):
+            logging.debug('%s: Skipping since it does not match the filter', logWhere)
+            self.counts['filteredSheets'] += 1
+            return
+
+        # Check for duplicate session:sheet
+        fingerprint=sheetFingerprint(sName,sh)
+        if fingerprint in self.sshIndex:
+            logging.warning('%s: Skipping because it is a duplicate of the sheet in file %s.',
+                logWhere,self.sshIndex[fingerprint])
+            self.counts['duplicateSheets'] += 1
+            if ledger:
+                self.waiting.setdefault(fingerprint, []).append(ledger)
+                undo(('waiting', fingerprint))
+            return
+        else:
+            self.sshIndex[fingerprint]=filename
+            undo(('fingerprint', fingerprint))
+
+        # Proceed
+        key=sh['grade']+sh['gender']+sh['eType']
+        station=sh['field']
+        group=sh['group']
+        categories=sh['categories']
+        ratingsValues=sh['ratingValues']
+
+        # Check if sheet is empty
+        if not sh['playerData']:
+            logging.warning('%s: Skipping since it contains no players', logWhere)
+            return
+    
+        # TODO - Update db in app and remove this kludge
+        # Check for old ratingsValues (indicates old data)
+        if file_extension != ".csv":
+            isOld=0
+            if (sh['eType']=='Night1' or sh['eType']=='Night2') and (len(sh['ratingValues']) != 6):
+                isOld=1
+            elif (sh['eType']=='Bubble') and (len(sh['ratingValues']) != 20):
+                isOld=1
+            if isOld:
+                # Should never get here unless db version incorrectly recorded in app
+                # or csv file is using wrong ratingValues.
+                # Any changes to pre-defined ratings should result in a new db version.
+                logging.warning('%s: Skipping since ratingsValues are old', logWhere)
+                return
+
+        # Check for old session
+        if sName[:4].isdigit():
+            sNum=int(sName[1:4])
+            if (sNum < 519):
+                logging.warning('%s: Possibly an old session; consider removing it,', logWhere)
+    
+        # Record key
+        if (key not in compilation):
+            logging.debug('%s: Adding compilation[%s]', logWhere,key)
+            compilation[key]=KeyStore()
+        self.changed.add(key)
+
+        # Check for sheetname having custom post-fix
+        shPostFix=shName.replace(key+station+group,"",1)
+    
+        # Handle unset station/field
+        if station=='':  # Should only happen with eType='Bubble' or 'Custom'
+            station="Field"
+        
+        if shPostFix:
+            # Record program comment.         
+            logging.warning("%s: Adding custom post-fix %s to %s", logWhere,shPostFix,station)
+            station+=shPostFix
+        
+        # Station of the sheet before any renaming.
+        base=station
+
+        # If Bubble field, try to make it unique.
+        if sh['eType']=='Bubble':
+            if compilation[key].isStation(station):
+                # Rename station.  Program comment recorded here since it's not necessary if new name comes from sheet name.
+                station=compilation[key].renameStation(logWhere,station)
+                self.counts['stationsRenamed'] += 1
+                undo(('kComment', key, compilation[key].kComments[-1]))
+        
+        # Record sheet comment
+        # First deal with non-ascii in comments.  Also remove \n and \r
+        shComment_ascii=removeNonAsciiCRLF(sh['comments'])
+        if shComment_ascii:
+            newShComment="{}: Has comment - {}".format(logWhere,shComment_ascii)
+            logging.info(newShComment)
+            compilation[key].kComments.append(newShComment)
+            undo(('kComment', key, newShComment))
+    
+        # Record categories and make sure they match
+        if (len(compilation[key].categories)) and (compilation[key].categories != categories):
+            # Should never get here unless db version incorrectly recorded in app.
+            # Any changes to pre-defined categories or ratings should result in a new db version.
+            logging.error('%s: Categories mismatch - %s != %s', logWhere,compilation[key].categories,categories)
+            return
+        else:
+            logging.debug('%s: Recording categories %s in compilation', logWhere,categories)
+            compilation[key].setCategories(categories)
 
-            # First check if players in this sheet already appear in a sheet for the same station.
-            # If so, rename the station.
-            for p in sh['playerData']:                
-                teamKey=p['team']
-                idNum = p['id']
-                if not type(idNum) is unicode:
-                    # Why make it unicode?
-                    idNum = unicode(idNum)
-                if not str(idNum).isdigit():
-                    continue
-                if compilation[key]['data'].get(teamKey,{}).get(idNum,{}).has_key(station):
-                    # Try to rename station
-                    nameFound=0
-                    count=1
-                    while (not nameFound) & (count < 10):
-                        newStationName=station + '-' + str(count)
-                        if (newStationName not in compilation[key]['stationList']):
-                            nameFound=1
-                            # Record program comment
-                            newProgComment="{}: Renamed {} to {}".format(logWhere,station,newStationName)
-                            logging.info(newProgComment)
-                            compilation[key]['kComments'].append("Program: "+newProgComment)
-                            station=newStationName
-                            break
-                        else:
-                            count+=1
-            # End of check if players in this sheet already appear in a sheet for the same station.
-            
-            # Process each player in sheet
+        # First check if players in this sheet already appear in a sheet for the same station.
+        # If so, rename the station.  A free name has no players yet, so one rename is enough.
+        if compilation[key].isStation(station):
             for p in sh['playerData']:
-                teamKey=p['team']
                 idNum = p['id']
-
-                # Why make it unicode?
                 if not type(idNum) is unicode:
+                    # Why make it unicode?
                     idNum = unicode(idNum)
                 if not str(idNum).isdigit():
-                    logging.error('File %s: Session %s: Sheet %s: Key %s: Team %s: Player %s is not a number.  Skipping',
-                                  filename, sName, shName, key, teamKey, idNum)
                     continue
+                rowNum = compilation[key].row(p['team'],idNum)
+                if rowNum is not None and compilation[key].hasStation(rowNum,station):
+                    station=compilation[key].renameStation(logWhere,station)
+                    self.counts['stationsRenamed'] += 1
+                    undo(('kComment', key, compilation[key].kComments[-1]))
+                    break
+        # End of check if players in this sheet already appear in a sheet for the same station.
+
+        # Record where the sheet's scores go, for retract().
+        if station != base:
+            self.renamed[(key, base)] = self.renamed.get((key, base), 0) + 1
+        undo(('station', key, station, base))
+    
+        # Process each player in sheet
+        sheetScores=scoreSheet(sh['playerData'],categories)
+        for p, (ratings,total,ratingsCount,problems) in zip(sh['playerData'],sheetScores):
+            teamKey=p['team']
+            idNum = p['id']
+
+            # Why make it unicode?
+            if not type(idNum) is unicode:
+                idNum = unicode(idNum)
+            if not str(idNum).isdigit():
+                logging.error('File %s: Session %s: Sheet %s: Key %s: Team %s: Player %s is not a number.  Skipping',
+                              filename, sName, shName, key, teamKey, idNum)
+                continue
 
-                logWhere="File {}: Session {}: Sheet {}: Player {}{}".format(filename,sName,shName,teamKey,idNum)
-                logging.info("{}: Processing...".format(logWhere))
-            
-                # For recording player comments
-                newPComment = ''
-                
-                # Record player team and id
-                if (teamKey not in compilation[key]['data']):
-                    logging.debug('{}: Recording team {} in compilation'.format(logWhere,teamKey))
-                    compilation[key]['data'][teamKey]={}
-                if (idNum not in compilation[key]['data'][teamKey]):
-                    logging.debug('{}: Recording id {} in compilation'.format(logWhere,idNum))
-                    compilation[key]['data'][teamKey].update({idNum:{}})
-
-                # Record sources; NOT PRINTED YET
-                #if 'sources' not in compilation[key]['data'][teamKey][idNum]:
-                #    compilation[key]['data'][teamKey][idNum].update({'sources':[]})
-                #logging.debug('{}: Recording source in compilation'.format(logWhere))
-                #compilation[key]['data'][teamKey][idNum]['sources'].append("{}:{}:{}".format(filename, sName, shName))
-
-                # Check for player appearing more than once in a station
-                if (station in compilation[key]['data'][teamKey][idNum]):
-                    logging.error('{}: Player already has scores for {}; recording in comments.'.format(logWhere,station))
-                    # Add player comment
-                    newPComment="File {} has additional scores for station {} ".format(filename,station)
-                    for c in categories:
-                        if c not in p['ratings']:
-                            rating = ''
-                        else:
-                            rating = p['ratings'][c]
-                        if rating == '':
-                            rating = '\"\"'
-                        newPComment+="{} = {} ".format(c,str(rating))
-                    newPComment+='. '
-                    
-                    if 'pComments' not in compilation[key]['data'][teamKey][idNum]:
-                        compilation[key]['data'][teamKey][idNum].update({'pComments':''})
+            logWhere=LogWhere(filename,session=sName,sheet=shName,player=(teamKey,idNum))
+            if logInfo:
+                logging.info("%s: Processing...", logWhere)
+    
+            # For recording player comments
+            newPComment = ''
         
-                    logging.debug('{}: Adding comment {} to compilation'.format(logWhere,newPComment))          
-                    compilation[key]['data'][teamKey][idNum]['pComments'] += newPComment
-                    newPComment = ''
-                    continue
-                
-                logging.info('{}: Adding {} ratings to compilation'.format(logWhere,station))
-                compilation[key]['data'][teamKey][idNum].update({station:{'ratings':{},'total':''}})
-                if (station not in compilation[key]['stationList']):
-                    logging.debug('{}: Adding {} to stationlist'.format(logWhere,station))
-                    compilation[key]['stationList'].append(station)
-
-                # Get scores and total score for this player.
-                total = 0
-                ratingsCount = 0
+            # Record player team and id
+            if (teamKey not in compilation[key].data):
+                logging.debug('%s: Recording team %s in compilation', logWhere,teamKey)
+            rowNum = compilation[key].row(teamKey,idNum)
+            if rowNum is None:
+                logging.debug('%s: Recording id %s in compilation', logWhere,idNum)
+                rowNum = compilation[key].addPlayer(teamKey,idNum)
+
+            # Check for player appearing more than once in a station
+            if compilation[key].hasStation(rowNum,station):
+                logging.error('%s: Player already has scores for %s; recording in comments.', logWhere,station)
+                # Add player comment
+                newPComment="File {} has additional scores for station {} ".format(filename,station)
                 for c in categories:
-                    # Validate rating and flag with a comment if necessary.
                     if c not in p['ratings']:
                         rating = ''
                     else:
                         rating = p['ratings'][c]
-                        
-                    if rating != '':
-                        origRating = rating
-                        if not (type(origRating) is float or str(origRating).isdigit()):
-                            logging.error('{}: Invalid rating "{}"; an average will be used.'.format(logWhere,origRating))
-                            newPComment += 'Invalid rating was ignored. '              
-                        else:
-                            # Make sure it's an int and warn if there is rounding.
-                            # xlrd reads numbers as floats and json reads them as strings.
-                            rating = int(round(float(origRating)))
-                            ratingsCount += 1
-                            total += rating
-                            if (float(origRating) != rating):
-                                logging.warning('{}: Rating "{}" was rounded to "{}"'.format(logWhere,origRating,rating))
-                                newPComment += 'Decimal rating was rounded. '
-
-                    logging.debug('{}: Adding rating {}={} to compilation'.format(logWhere,c, rating))
-                    compilation[key]['data'][teamKey][idNum][station]['ratings'][c]=rating
-                # End of ratings gathering
-
-                # Record total for this player at this station.
-                # Handle averaging of ratings (when ratings are missing)
-                origTotal = total
-                if 0 == ratingsCount:
-                    logging.warning('{}: Has no ratings'.format(logWhere))
-                    newPComment+="In station {} but with no ratings. ".format(station)
-                    # TODO: If all ratings missing, should we ignore player for that station and give different error message?
-                elif ratingsCount < len(categories):
-                    logging.warning('{}: Missing ratings - an average will be used.'.format(logWhere))
-                    newPComment += 'Missing rating so average used. '
-                    total = int( round(len(categories) * total/float(ratingsCount)) )
-                    
-                logging.debug('{}: Adding total {} to compilation'.format(logWhere,total))
-                compilation[key]['data'][teamKey][idNum][station]['total']=total
-                
-                # If there is a comment, record it.
-                if newPComment:
-                    logging.info('{}: Adding a comment to compilation'.format(logWhere))
-                    if 'pComments' not in compilation[key]['data'][teamKey][idNum]:
-                        compilation[key]['data'][teamKey][idNum].update({'pComments':''})
-                    compilation[key]['data'][teamKey][idNum]['pComments'] += newPComment
-                    logging.info('newPComment: %s', newPComment)
-                    newPComment = ''
-
-            # End of player processing
-        # End of sheet processing
-    # End of session processing
-# End allData processing
-
-# Print compilation
-for key in sorted(compilation):
-    print(key + ',')
-    # First heading row
-    print('id,'),
-    for station in sorted(compilation[key]['stationList']):
-        # Print for categories
-        for c in compilation[key]['categories']:
-            print(station + ','),
-        # and for total
-        if 1 < len(compilation[key]['categories']):
-            print(station + ','),
-    print('Comments (see ' + LOGNAME + ' for details),')
-
-    # Second heading row
-    print(','),
-    for station in sorted(compilation[key]['stationList']):
-        # Print heading for categories
-        for c in compilation[key]['categories']:
-            print(c + ','),
-        # Print heading for total
-        if 1 < len(compilation[key]['categories']):
-            print('Total,'),
-    print(',')
-
-    for teamKey in sorted(compilation[key]['data']):
-        for idNum in sorted(compilation[key]['data'][teamKey],key=int):
-            # Use only 1 char of team and make lowercase
-            print(str(teamKey.lower()[:1]) + str(idNum) + ','),
-
-            for station in sorted(compilation[key]['stationList']):
-                # Print station category scores
-                for c in compilation[key]['categories']:
-                    if station in compilation[key]['data'][teamKey][idNum]:
-                        print(str(compilation[key]['data'][teamKey][idNum][station]['ratings'][c]) + ','),
-                    else:
-                        print(','),
-                # Print station total
-                if 1 < len(compilation[key]['categories']):
-                    if station in compilation[key]['data'][teamKey][idNum]:
-                        print(str(compilation[key]['data'][teamKey][idNum][station]['total']) + ','),
-                    else:
-                        print(','),
-            # Print player comments
-            if 'pComments' in compilation[key]['data'][teamKey][idNum]:
-                print(str(compilation[key]['data'][teamKey][idNum]['pComments']) + ',')
+                    if rating == '':
+                        rating = '\"\"'
+                    newPComment+="{} = {} ".format(c,str(rating))
+                newPComment+='. '
+            
+                logging.debug('%s: Adding comment %s to compilation', logWhere,newPComment)          
+                compilation[key].addComment(rowNum,newPComment)
+                undo(('pComment', key, teamKey, idNum, newPComment))
+                self.conflicts.add((key, station))
+                newPComment = ''
+                continue
+        
+            if logInfo:
+                logging.info('%s: Adding %s ratings to compilation', logWhere,station)
+            if not compilation[key].isStation(station):
+                logging.debug('%s: Adding %s to stationlist', logWhere,station)
+                compilation[key].addStation(station)
+
+            # Flag invalid and rounded ratings with a comment.
+            for c, problem, origRating, rating in problems:
+                if problem == INVALID_RATING:
+                    logging.error('%s: Invalid rating "%s"; an average will be used.', logWhere,origRating)
+                    newPComment += 'Invalid rating was ignored. '              
+                else:
+                    logging.warning('%s: Rating "%s" was rounded to "%s"', logWhere,origRating,rating)
+                    newPComment += 'Decimal rating was rounded. '
+            if logDebug:
+                for c, rating in zip(categories, ratings):
+                    logging.debug('%s: Adding rating %s=%s to compilation', logWhere,c, rating)
+
+            # Comment on missing ratings; the total is an average of the rest.
+            if 0 == ratingsCount:
+                logging.warning('%s: Has no ratings', logWhere)
+                newPComment+="In station {} but with no ratings. ".format(station)
+                # TODO: If all ratings missing, should we ignore player for that station and give different error message?
+            elif ratingsCount < len(categories):
+                self.counts['ratingsAveraged'] += 1
+                logging.warning('%s: Missing ratings - an average will be used.', logWhere)
+                newPComment += 'Missing rating so average used. '
+            
+            if logDebug:
+                logging.debug('%s: Adding total %s to compilation', logWhere,total)
+            compilation[key].setScores(rowNum,station,ratings,total)
+            undo(('scores', key, teamKey, idNum, station))
+            self.counts['players'] += 1
+        
+            # If there is a comment, record it.
+            if newPComment:
+                logging.info('%s: Adding a comment to compilation', logWhere)
+                compilation[key].addComment(rowNum,newPComment)
+                undo(('pComment', key, teamKey, idNum, newPComment))
+                logging.info('newPComment: %s', newPComment)
+                newPComment = ''
+
+        # End of player processing
+
+    # Return [(key, csv table of key)] of the report in key order.
+    # Tables are kept, so only the keys changed since the last call are
+    # rendered again.
+    def renderKeys(self):
+        self.expireKeys()
+        tables = []
+        for key in sorted(self.compilation):
+            if key not in self.rendered:
+                self.rendered[key] = keyReport(key, self.compilation[key])
+            tables.append((key, self.rendered[key]))
+        return tables
+
+    # Write the csv report of the compilation.
+    def render(self, outFile):
+        for key, table in self.renderKeys():
+            outFile.write(table)
+
+    # Return the Rankings of a key; they are kept until the key changes.
+    def ranking(self, key):
+        self.expireKeys()
+        if key not in self.rankings:
+            self.rankings[key] = Rankings(self.compilation[key])
+        return self.rankings[key]
+
+    # Write the --rank report of the compilation.
+    def renderRankings(self, outFile, top=None):
+        for key in sorted(self.compilation):
+            outFile.write(rankReport(key, self.ranking(key), top))
+
+    # Drop the rendered tables and rankings of the keys changed since, or gone.
+    def expireKeys(self):
+        for key in self.changed:
+            self.rendered.pop(key, None)
+            self.rankings.pop(key, None)
+        self.changed = set()
+        for cache in (self.rendered, self.rankings):
+            for key in set(cache) - set(self.compilation):
+                del cache[key]
+
+# Write the report to a temporary file and move it over outputName, so
+# readers never see a partly written report.
+def writeReportFile(compiler, outputName):
+    tmpName = outputName + '.tmp'
+    with open(tmpName,'wb') as outFile:
+        compiler.render(outFile)
+    try:
+        os.rename(tmpName, outputName)
+    except OSError:
+        # Windows will not rename over an existing file.
+        os.remove(outputName)
+        os.rename(tmpName, outputName)
+
+# Tables of the --export-db database; bump DB_SCHEMA_VERSION (stored as
+# PRAGMA user_version) when they change.
+# A rating or total is an int, or the invalid rating as given in the file,
+# so those columns have no declared type.  An id is the text the compilation
+# keys players by, so 07 and 7 are different players, as in the report.
+DB_SCHEMA_VERSION = 2
+DB_SCHEMA = [
+    'CREATE TABLE keys (key TEXT PRIMARY KEY, categories TEXT)',
+    'CREATE TABLE stations (key TEXT, station TEXT, PRIMARY KEY (key, station))',
+    'CREATE TABLE players (key TEXT, team TEXT, id TEXT, comment TEXT, PRIMARY KEY (key, team, id))',
+    'CREATE TABLE ratings (key TEXT, team TEXT, id TEXT, station TEXT, category TEXT, rating, '
+    'PRIMARY KEY (key, team, id, station, category))',
+    'CREATE TABLE totals (key TEXT, team TEXT, id TEXT, station TEXT, total, '
+    'PRIMARY KEY (key, team, id, station))',
+    'CREATE TABLE comments (key TEXT, position INTEGER, comment TEXT, PRIMARY KEY (key, position))',
+    'CREATE INDEX ratingsByStation ON ratings (key, station, category)',
+    'CREATE INDEX totalsByStation ON totals (key, station)',
+]
+
+# Return a rating or total as sqlite can store it: invalid ratings such as
+# lists are stored as text, as the csv report writes them.
+def dbValue(value):
+    if value is None or isinstance(value, (int, long, float, basestring)):
+        return value
+    return str(value)
+
+# Iterate over (key, team, id, station, ratings, total) of every score in the compilation.
+def compiledScores(compilation):
+    for key in sorted(compilation):
+        store = compilation[key]
+        stations = sorted(station for station in store.stationList if store.stationUsed(station))
+        for teamKey, idNum, rowNum in store.players():
+            for station in stations:
+                scores = store.scores(rowNum, station)
+                if scores:
+                    yield key, teamKey, idNum, station, scores[0], scores[1]
+
+# Write the compilation to a new sqlite database, one row per key, team,
+# player, station and category in the ratings table, with the station totals
+# (of keys with more than one category, as in the report) in the totals table.
+# Like writeReportFile(), the database is written under a temporary name first.
+def writeDatabase(compiler, outputName):
+    compilation = compiler.compilation
+    tmpName = outputName + '.tmp'
+    if os.path.exists(tmpName):
+        os.remove(tmpName)
+    db = sqlite3.connect(tmpName)
+    try:
+        # Nothing reads the temporary file until it is complete.
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('PRAGMA user_version = {}'.format(DB_SCHEMA_VERSION))
+        for statement in DB_SCHEMA:
+            db.execute(statement)
+        db.executemany('INSERT INTO keys VALUES (?,?)',
+                       ((key, ','.join(compilation[key].categories)) for key in compilation))
+        db.executemany('INSERT INTO stations VALUES (?,?)',
+                       ((key, station) for key, store in compilation.items()
+                        for station in store.stationList if store.stationUsed(station)))
+        db.executemany('INSERT INTO players VALUES (?,?,?,?)',
+                       ((key, teamKey, idNum, store.comment(rowNum) or None)
+                        for key, store in compilation.items()
+                        for teamKey, idNum, rowNum in store.players()))
+        scores = list(compiledScores(compilation))
+        db.executemany('INSERT INTO ratings VALUES (?,?,?,?,?,?)',
+                       ((key, teamKey, idNum, station, category, dbValue(rating))
+                        for key, teamKey, idNum, station, ratings, total in scores
+                        for category, rating in zip(compilation[key].categories, ratings)
+                        if rating != ''))
+        db.executemany('INSERT INTO totals VALUES (?,?,?,?,?)',
+                       ((key, teamKey, idNum, station, dbValue(total))
+                        for key, teamKey, idNum, station, ratings, total in scores
+                        if len(compilation[key].categories) > 1))
+        db.executemany('INSERT INTO comments VALUES (?,?,?)',
+                       ((key, position, comment) for key, store in compilation.items()
+                        for position, comment in enumerate(store.kComments)))
+        db.commit()
+    except:
+        db.close()
+        os.remove(tmpName)
+        raise
+    db.close()
+    if os.path.exists(outputName):
+        os.remove(outputName)
+    os.rename(tmpName, outputName)
+
+# Return {filename: (size, mtime)} of the data files in a folder,
+# leaving out the report and this script's own files.  Data files are those
+# expandFolders() reads, except archives, which are not watched; other files
+# (.DS_Store, partly copied temporary files, ...) are ignored.
+def folderStamps(folder, skip):
+    stamps = {}
+    for name in os.listdir(folder):
+        filename = os.path.join(folder, name)
+        if not name.lower().endswith(DATA_EXTENSIONS) or isArchive(name) or os.path.abspath(filename) in skip:
+            continue
+        try:
+            st = os.stat(filename)
+        except OSError:  # Removed while listing.
+            continue
+        if os.path.isfile(filename):
+            stamps[filename] = (st.st_size, st.st_mtime)
+    return stamps
+
+# Watch a folder for new, changed and removed files and rewrite the report
+# whenever the folder changes.  Nothing is done until the folder has looked
+# the same for one interval, so a burst of copies triggers one update and
+# half-copied files are not read.
+# Only new and changed files are parsed, and only their new and changed
+# sheets are compiled, with an incremental Compiler.  If that cannot retract
+# a sheet cleanly, the compilation is rebuilt from the parsed data kept for
+# every file.
+def watchFolder(folder, outputName, interval, jobs, logLevel, cache, sheetFilter):
+    skip = set(os.path.abspath(name) for name in
+               (outputName, outputName + '.tmp', LOGNAME, CACHENAME, CACHENAME + '-journal'))
+    fileData = {}   # filename -> file_data of each valid file
+    loaded = {}     # filename -> (size, mtime) when it was loaded
+    compiler = Compiler(sheetFilter=sheetFilter, incremental=True)
+    previous = None
+    while True:
+        current = folderStamps(folder, skip)
+        if current == previous and current != loaded:
+            startTime = time.time()
+            changed = sorted(filename for filename in current if loaded.get(filename) != current[filename])
+            removed = [filename for filename in loaded if filename not in current]
+            logging.info('Watch: New or changed files %s, removed files %s', changed, removed)
+            results = loadFiles(changed, jobs, logLevel, cache, sheetFilter=sheetFilter)
+            for filename in removed:
+                fileData.pop(filename, None)
+                compiler.remove(filename)
+            for filename, file_data in zip(changed, results):
+                if file_data[0] is not None:
+                    fileData[filename] = file_data[0]
+                    compiler.add(file_data[0])
+                elif fileData.pop(filename, None) is not None:
+                    compiler.remove(filename)
+            list(validFiles(results))  # Report invalid files.
+            loaded = current
+
+            if compiler.needsRebuild:
+                logging.info('Watch: Recompiling %s files', len(fileData))
+                compiler = Compiler(sheetFilter=sheetFilter, incremental=True)
+                for filename in sorted(fileData):
+                    compiler.add(fileData[filename])
+            writeReportFile(compiler, outputName)
+            logging.info('Watch: Wrote %s in %.3f seconds', outputName, time.time() - startTime)
+            print "Updated {} from {} files".format(outputName, len(fileData))
+            sys.stdout.flush()
+        previous = current
+        time.sleep(interval)
+
+# Largest file accepted by the --serve server.
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+# The --serve server.  Tablets, or a helper, upload their files with
+#   PUT or POST /files/<name>   e.g. curl --data-binary @soccer.txt http://<laptop>:8000/files/soccer.t3.txt
+#   DELETE /files/<name>
+# and the report is downloaded with
+#   GET /report.csv             every key
+#   GET /report/<key>.csv       one key, e.g. /report/6thGirlsNight1.csv
+# A file uploaded again under the same name replaces the earlier one.
+# Each request is handled in its own thread.  Uploads are parsed outside
+# the lock, in a pool of worker processes if there is one, and then
+# compiled one at a time into an incremental Compiler, so a changed upload
+# only recompiles its changed sheets and a download only renders the keys
+# changed since the last one.
+class UploadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Room for a room full of tablets connecting at once; the default is 5.
+    request_queue_size = 128
+
+    def __init__(self, address, pool, sheetFilter):
+        BaseHTTPServer.HTTPServer.__init__(self, address, UploadHandler)
+        self.pool = pool
+        self.sheetFilter = sheetFilter
+        self.lock = threading.Lock()
+        self.fileData = {}   # name -> file_data of each valid upload
+        self.compiler = Compiler(sheetFilter=sheetFilter, incremental=True)
+
+    # Parse an upload; returns (file_data, logComment) like loadFile().
+    def parse(self, name, data):
+        data = stripBom(data)
+        if self.pool:
+            return self.pool.apply(parseData, (name, data, self.sheetFilter))
+        return parseData(name, data, self.sheetFilter)
+
+    def add(self, file_data):
+        with self.lock:
+            self.fileData[file_data['filename']] = file_data
+            self.compiler.add(file_data)
+            self.checkRebuild()
+
+    # Returns False if no file was uploaded under name.
+    def remove(self, name):
+        with self.lock:
+            if self.fileData.pop(name, None) is None:
+                return False
+            self.compiler.remove(name)
+            self.checkRebuild()
+            return True
+
+    def checkRebuild(self):
+        if self.compiler.needsRebuild:
+            logging.info('Serve: Recompiling %s files', len(self.fileData))
+            self.compiler = Compiler(sheetFilter=self.sheetFilter, incremental=True)
+            for name in sorted(self.fileData):
+                self.compiler.add(self.fileData[name])
+
+    # Return [(key, csv table of key)] of the current report.
+    def report(self):
+        with self.lock:
+            return self.compiler.renderKeys()
+
+    # Return the current --rank report.
+    def rankReport(self):
+        outFile = cStringIO.StringIO()
+        with self.lock:
+            self.compiler.renderRankings(outFile)
+        return outFile.getvalue()
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urllib.unquote(self.path.split('?')[0])
+        if path == '/':
+            self.reply(200, ''.join('/report/{}.csv\n'.format(key) for key, table in self.server.report()) +
+                       '/rank.csv\n')
+        elif path == '/report.csv':
+            self.reply(200, ''.join(table for key, table in self.server.report()), 'text/csv')
+        elif path == '/rank.csv':
+            self.reply(200, self.server.rankReport(), 'text/csv')
+        elif path.startswith('/report/') and path.endswith('.csv'):
+            table = dict(self.server.report()).get(path[len('/report/'):-len('.csv')])
+            if table is None:
+                self.reply(404, 'No report for that key\n')
             else:
-                print(',')
-            # End of station processing
-        # End of idNum processing
-    # End of teamKey processing
-    # Print comments, if any
-    if compilation[key]['kComments']:
-        print('Comments:')
-        for c in compilation[key]['kComments']:
-            #print('  ' + c + ',')
-            print('"  ' + c + '",')
-    print(',')
-# End of key processing 
+                self.reply(200, table, 'text/csv')
+        else:
+            self.reply(404, 'Not found\n')
+
+    def do_POST(self):
+        name = self.uploadName()
+        if name is None:
+            return
+        try:
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            self.reply(411, 'Content-Length is required\n')
+            return
+        if MAX_UPLOAD_BYTES < length:
+            self.reply(413, 'Files are limited to {} bytes\n'.format(MAX_UPLOAD_BYTES))
+            return
+        data = self.rfile.read(length)
+        file_data, logComment = self.server.parse(name, data)
+        if file_data is None:
+            logging.error(logComment)
+            self.reply(422, logComment + '\n')
+            return
+        self.server.add(file_data)
+        self.reply(200, ''.join(line + '\n' for line in ['Compiled ' + name] + file_data.get('quarantined', [])))
+
+    do_PUT = do_POST
+
+    def do_DELETE(self):
+        name = self.uploadName()
+        if name is None:
+            return
+        if self.server.remove(name):
+            self.reply(200, 'Removed {}\n'.format(name))
+        else:
+            self.reply(404, 'No file {}\n'.format(name))
+
+    # Return the name of the file in a /files/<name> path, or None after
+    # replying with an error.  Names need a data file extension, which
+    # tells csv backups apart.
+    def uploadName(self):
+        path = urllib.unquote(self.path.split('?')[0])
+        name = path[len('/files/'):]
+        if not path.startswith('/files/') or not name or '/' in name or '\\' in name or name.startswith('.'):
+            self.reply(404, 'Upload files to /files/<name>\n')
+            return None
+        if os.path.splitext(name)[1].lower() not in ('.txt', '.csv', '.json'):
+            self.reply(400, 'File names must end in .txt, .csv or .json\n')
+            return None
+        return name
+
+    def reply(self, code, body, contentType='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info('Serve: %s - %s', self.client_address[0], format % args)
+
+# Run the --serve server on (host, port) until interrupted.
+# Uploads are parsed in a pool of jobs worker processes (0 = one per CPU)
+# unless jobs is 1.
+def serveUploads(address, jobs, logLevel, sheetFilter):
+    pool = None
+    if jobs != 1:
+        pool = multiprocessing.Pool(jobs or None, initWorker, (logLevel,))
+    server = UploadServer(address, pool, sheetFilter)
+    try:
+        print "Serving on port {}; upload to /files/<name>, report at /report.csv".format(server.server_address[1])
+        sys.stdout.flush()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if pool:
+            pool.terminate()
+            pool.join()
+
+# Phase timers and counters of a run, written by --metrics-json.
+# Cpu seconds include the finished --jobs worker processes.
+class Metrics(object):
+    def __init__(self, traceMemory):
+        self.phases = []     # {'phase', 'wall', 'cpu'} in run order
+        self.fileTimes = {}  # filename -> seconds to parse it
+        self.counts = {}
+        self.current = None
+        self.traceMemory = traceMemory and tracemalloc is not None
+        if self.traceMemory:
+            tracemalloc.start()
+
+    def start(self, phase):
+        self.end()
+        times = os.times()
+        self.current = (phase, time.time(), sum(times[:4]))
+
+    def end(self):
+        if self.current:
+            phase, wall, cpu = self.current
+            times = os.times()
+            self.phases.append({'phase': phase,
+                                'wall': round(time.time() - wall, 6),
+                                'cpu': round(sum(times[:4]) - cpu, 6)})
+            self.current = None
+
+    # Return (peak bytes, how it was measured), or (None, None).
+    def peakMemory(self):
+        if self.traceMemory:
+            return tracemalloc.get_traced_memory()[1], 'tracemalloc'
+        if resource:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != 'darwin':  # kilobytes, except on Mac
+                maxrss *= 1024
+            return maxrss, 'maxrss'
+        return None, None
+
+    def write(self, filename):
+        self.end()
+        peak, peakSource = self.peakMemory()
+        summary = {'argv': sys.argv,
+                   'phases': self.phases,
+                   'fileParseSeconds': dict((name, round(seconds, 6)) for name, seconds in self.fileTimes.items()),
+                   'counts': self.counts,
+                   'peakMemory': peak,
+                   'peakMemorySource': peakSource}
+        with open(filename,'w') as metricsFile:
+            json.dump(summary, metricsFile, indent=2, sort_keys=True)
+
+def main():
+    # Process arguments
+    # Could use type=argparse.FileType('r'), but need to easily get list of filenames.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files',
+                        nargs='*',
+                        help='JSon or csv files containing evaluation data, zip/tar archives of them, '
+                             'or folders to search for them')
+    parser.add_argument('--log-level',
+                        default='WARNING',
+                        dest='log_level',
+                        choices=_LOGGING_LEVELS,
+                        nargs='?',
+                        help='Set the logging output level')
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help='Number of worker processes used to parse files (0 = one per CPU)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        dest='no_cache',
+                        help='Parse every file instead of using the ' + CACHENAME + ' parse cache')
+    parser.add_argument('--clear-cache',
+                        action='store_true',
+                        dest='clear_cache',
+                        help='Discard the ' + CACHENAME + ' parse cache before running')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='Stream json files one sheet at a time into the compilation '
+                             'instead of loading every file first (ignores --jobs and the cache)')
+    parser.add_argument('--output',
+                        metavar='PATH',
+                        help='Write the csv report to PATH instead of stdout')
+    parser.add_argument('--rank',
+                        action='store_true',
+                        help='Print a ranking of the players of each key by their total over all stations, '
+                             'with percentiles, instead of the report')
+    parser.add_argument('--top',
+                        type=int,
+                        metavar='N',
+                        help='Only rank the top N players of each key with --rank')
+    parser.add_argument('--export-db',
+                        metavar='PATH',
+                        dest='export_db',
+                        help='Also write the compiled data to PATH as an sqlite database '
+                             '(see the Notes at the end of the script)')
+    parser.add_argument('--watch',
+                        metavar='DIR',
+                        help='Keep watching DIR and rewrite the --output report whenever '
+                             'files are added, changed or removed (stop with Ctrl-C)')
+    parser.add_argument('--serve',
+                        metavar='[HOST:]PORT',
+                        help='Run a server that compiles files uploaded to it and serves the report '
+                             '(stop with Ctrl-C); HOST defaults to all interfaces')
+    parser.add_argument('--interval',
+                        default=2.0,
+                        type=float,
+                        help='Seconds between checks of the --watch folder (default 2)')
+    parser.add_argument('--key',
+                        action='append',
+                        metavar='KEY',
+                        help='Only compile the report for KEY, e.g. 6thGirlsNight1 (may be repeated)')
+    parser.add_argument('--grade',
+                        action='append',
+                        help='Only compile sheets for GRADE, e.g. 6th (may be repeated)')
+    parser.add_argument('--gender',
+                        action='append',
+                        help='Only compile sheets for GENDER, e.g. Girls (may be repeated)')
+    parser.add_argument('--etype',
+                        action='append',
+                        metavar='ETYPE',
+                        help='Only compile sheets of evaluation type ETYPE, e.g. Night1 (may be repeated)')
+    parser.add_argument('--metrics-json',
+                        metavar='PATH',
+                        dest='metrics_json',
+                        help='Write phase timings, counters and peak memory of the run to PATH as json')
+    parser.add_argument('--profile',
+                        metavar='PATH',
+                        help='Write a cProfile dump of the run to PATH (read it with pstats; '
+                             '--jobs workers are not profiled)')
+    #parser.add_argument("--pdb", default=False)
+    args = parser.parse_args()
+    if args.watch:
+        if args.files:
+            parser.error('--watch does not take files')
+        if args.serve:
+            parser.error('--watch and --serve cannot be used together')
+        if args.export_db:
+            parser.error('--export-db cannot be used with --watch')
+        if args.rank:
+            parser.error('--rank cannot be used with --watch')
+        if not args.output:
+            parser.error('--watch needs --output')
+        if not os.path.isdir(args.watch):
+            parser.error('--watch: {} is not a folder'.format(args.watch))
+    elif args.serve:
+        if args.files:
+            parser.error('--serve does not take files')
+        if args.export_db:
+            parser.error('--export-db cannot be used with --serve')
+        if args.rank:
+            parser.error('--rank cannot be used with --serve; download /rank.csv instead')
+        host, _, port = args.serve.rpartition(':')
+        if not port.isdigit():
+            parser.error('--serve: {} is not a port'.format(port))
+        args.serve = (host, int(port))
+    elif not args.files:
+        parser.error('too few arguments')
+    if args.top is not None:
+        if not args.rank:
+            parser.error('--top needs --rank')
+        if args.top < 1:
+            parser.error('--top: N must be at least 1')
+
+    # Configure logging
+    logging.basicConfig(filename=LOGNAME, filemode='w', level=args.log_level)
+    logging.info('Argument List: %s', str(sys.argv))
+
+    metrics = Metrics(args.metrics_json is not None)
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, args, metrics)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run(args, metrics)
+    if args.metrics_json:
+        metrics.write(args.metrics_json)
+
+# Run with the parsed arguments, timing the phases in metrics.
+def run(args, metrics):
+    sheetFilter = None
+    if args.key or args.grade or args.gender or args.etype:
+        sheetFilter = SheetFilter(args.key, args.grade, args.gender, args.etype)
+
+    if args.watch:
+        cache = None
+        if not args.no_cache:
+            cache = openCache(CACHENAME, args.clear_cache)
+        try:
+            watchFolder(args.watch, args.output, args.interval, args.jobs, args.log_level, cache, sheetFilter)
+        except KeyboardInterrupt:
+            logging.info('Watch: Stopped')
+        finally:
+            if cache:
+                cache.close()
+        return
+
+    if args.serve:
+        try:
+            serveUploads(args.serve, args.jobs, args.log_level, sheetFilter)
+        except KeyboardInterrupt:
+            logging.info('Serve: Stopped')
+        return
+
+    # Handle file wildcards
+    metrics.start('collect')
+    gfilelist = []
+    for argf in args.files:
+        for globargf in glob.glob(argf):
+            gfilelist.append(globargf)
+
+    # Read the data files in folders, and the members of zip and tar archives.
+    gfilelist = expandArchives(expandFolders(gfilelist))
+        
+    # Remove duplicates and sort the list of files.
+    filelist = sorted(list(set(gfilelist)))
+    logging.info('Files (%s): %s', len(filelist), filelist)
+
+    # Parse only one of each set of identical files.
+    # The parse cache has the hashes of the files that did not change.
+    cache = None
+    if not args.no_cache and not args.stream:
+        cache = openCache(CACHENAME, args.clear_cache)
+    inputFiles = len(filelist)
+    filelist, digests = uniqueFiles(filelist, cache)
+
+    # Define patterns for processing the player id (in csv and excel files).
+    leadingChars="^[a-z,A-Z]*"
+    endingNums="[0-9]*$"
+
+    # Read each file,
+    # determine the type and put non-JSON files into the JSON format of the app datafile.
+    # Then process all of the data with a Compiler for printing.
+
+    # Collect the data as a list of dictionaries,
+    # one dictionary for each valid file.
+    logging.info("=== Collecting data from files...")
+
+    metrics.start('scan')
+    uniqueCount = len(filelist)
+    filelist, latestDBVersion = latestVersionFiles(filelist)
+    logging.info('Db version %s: %s files', latestDBVersion, len(filelist))
+
+    metrics.start('parse')
+    if args.stream:
+        # Parse each file only when the compilation reaches it.
+        results = (streamFile(filename, sheetFilter) for filename in filelist)
+        allData = validFiles(results)
+    else:
+        results = loadFiles(filelist, args.jobs, args.log_level, cache, metrics.fileTimes, sheetFilter, digests)
+        if cache:
+            cache.close()
+        allData = list(validFiles(results))
+
+    # End of file processing
+
+    ## Process all the data
+    logging.info("=== Processing all the data...")
+
+    # When streaming, files are parsed as they are compiled.
+    metrics.start('compile')
+    compiler = Compiler(latestDBVersion, sheetFilter)
+    for item in allData:
+        compiler.add(item)
+    metrics.counts = dict(compiler.counts, inputFiles=inputFiles, copiedFiles=inputFiles - uniqueCount,
+                          oldVersionFiles=uniqueCount - len(filelist),
+                          invalidFiles=len(filelist) - compiler.counts['files'])
+
+    # Print compilation
+    metrics.start('print')
+    if args.rank:
+        render = lambda outFile: compiler.renderRankings(outFile, args.top)
+    else:
+        render = compiler.render
+    if args.output:
+        with open(args.output,'wb') as outFile:
+            render(outFile)
+    else:
+        render(sys.stdout)
+    if args.export_db:
+        metrics.start('export')
+        writeDatabase(compiler, args.export_db)
+    metrics.end()
+
+if __name__ == '__main__':
+    main()
 
 ## Notes
 ##
@@ -821,3 +2721,44 @@ for key in sorted(compilation):
 ##      Python should already be installed
 ##
 
+##  Getting the data off tablets
+##    The app keeps its data in soccer.txt (the json format read here) in the tablet's
+##    external storage root and saves it after every change; it does not use a database.
+##    So there is no need to export or email it first; copy it off directly, e.g.
+##      adb pull /sdcard/soccer.txt soccer.<tablet>.txt
+##    soccer.csv is only written when a csv backup is made in the app.
+##
+##  Using from python
+##    The script name is not a valid module name, so load it by path, e.g.
+##      processData = imp.load_source('processData', 'processData-20180516.py')
+##    Then keep a Compiler and add files to it as they arrive:
+##      compiler = processData.Compiler()
+##      file_data, logComment = processData.loadFile('soccer.txt')
+##      if file_data is not None:
+##          compiler.add(file_data)
+##      compiler.render(sys.stdout)
+##    With Compiler(incremental=True), adding a file again only recompiles the sheets
+##    that changed (by their lastRatingsChange), and compiler.remove(filename) takes
+##    a file out; check compiler.needsRebuild after either.
+##    Logging is left to the caller.
+##    processData.writeDatabase(compiler, 'season.db') writes what --export-db does.
+##    compiler.ranking(key) returns the Rankings of a key, e.g. for 6thGirlsNight1:
+##      rankings = compiler.ranking('6thGirlsNight1')
+##      rankings.top(10)                      [((team, id), total over all stations), ...]
+##      rankings.rank(('Green', u'38'), 'Station5', 'A')
+##      rankings.percentile(('Green', u'38'), 'Station5')   of the Station5 total
+##    They are computed when first asked for and kept until data for the key changes.
+##
+##  The --export-db database
+##    Instead of parsing the csv report, load or query the compilation from sqlite, e.g.
+##      SELECT team, id, SUM(total) FROM totals WHERE key='6thGirlsNight1' GROUP BY team, id
+##    Tables (key is grade+gender+eType, e.g. 6thGirlsNight1; team is the full team name):
+##      keys (key, categories)          categories comma separated, in report order
+##      stations (key, station)
+##      players (key, team, id, comment)   id is text, e.g. '7'; '07' is another player
+##      ratings (key, team, id, station, category, rating)   one row per rating given
+##      totals (key, team, id, station, total)   only for keys with more than one category
+##      comments (key, position, comment)       the Comments: lines of the report
+##    A rating or total is an int, or the invalid rating as it was given.
+##    PRAGMA user_version is the version of this layout.
+##